@@ -2,6 +2,9 @@
 Author: Andrew Yaroshevych
 Version: 2.8.6 Development
 """
+# Imported first, so the time it takes to import the rest is measured
+from modules import import_budget
+
 import os
 import io
 import json
@@ -14,20 +17,18 @@ from datetime import datetime
 
 from email.message import EmailMessage
 
-from PIL import Image
-from pyzbar.pyzbar import decode
-
 from dotenv import load_dotenv
 
-from pymongo import MongoClient
-
 from telegram import ReplyKeyboardMarkup, Update, KeyboardButton, ForceReply, ChatAction, InlineKeyboardButton, \
     InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackContext, \
     CallbackQueryHandler
 
-from modules.face_recognition import find_faces
-from modules import validators, statistics
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+from modules import validators, statistics, barcode_decoder, photo_store, indexes, country_codes, \
+    database, face_recognition
+from modules.cache import LRUCache, MISSING, document_size
 
 
 logging.basicConfig(
@@ -39,8 +40,7 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-cluster = MongoClient(os.environ.get('cluster'))
-db = cluster.TestBotDatabase
+db = database.get_database()
 collection = db.TestBotCollection
 admins_collection = db.Administrators
 blacklist = db.Blacklist
@@ -57,6 +57,14 @@ MAIN_REPLY_KEYBOARD = [['Перевірити наявність', 'Додати
 
 UNDER_MAINTENANCE = os.environ.get('UNDER_MAINTENANCE') == "True"
 
+# Results of get_db_query_result by barcode. Writes made by this bot invalidate the entries,
+# the TTL bounds how long changes made by the other bot may stay unnoticed
+query_cache = LRUCache(
+    max_size=int(os.environ.get('DB_CACHE_BYTES', 32 * 1024 * 1024)),
+    ttl=float(os.environ.get('DB_CACHE_TTL', 120)),
+    size_of=document_size,
+)
+
 
 def under_maintenance(func):
     """
@@ -235,14 +243,22 @@ def scan_handler(update: Update, context: CallbackContext) -> None:
 def get_db_query_result(barcode) -> bool or None:
     """
     The get_db_query_result function takes a barcode as an argument and returns the result of a MongoDB query.
-    If no results are found, it returns None.
+    If no results are found, it returns None. Results are kept in query_cache, so popular barcodes
+    are answered without a round-trip to the database.
 
     :param barcode: Check if the barcode exists in the database
     :return: A dictionary with the product information if the barcode exists in the database
     """
+    query_result = query_cache.get(barcode, MISSING)
+    if query_result is not MISSING:
+        logger.info("Database query result found in cache")
+        return query_result
+
     try:
         logger.info("Database quired. Checking availability")
         query_result = collection.find_one({"code": barcode}, {"_id": 0})
+        query_cache.set(barcode, query_result)
+
         if query_result is None:
             return
 
@@ -272,9 +288,25 @@ def format_query(query_result) -> str or None:
         return
 
 
+def format_country(barcode) -> str:
+    """
+    The format_country function returns a line with the country of the GS1 organisation that issued the barcode.
+
+    :param barcode: Barcode to find the country for
+    :return: A formatted line or an empty string if the country is unknown
+    """
+    country = country_codes.get_country(barcode)
+
+    if country is None:
+        return ''
+
+    return f"\n🌍 Країна реєстрації штрих-коду: <b>{country}</b>"
+
+
 def retrieve_query_photo(query_result) -> bytes or None:
     """
-    The retrieve_query_photo function retrieves the photo from a query result.
+    The retrieve_query_photo function retrieves the photo of a query result.
+    Photos are kept in GridFS and only loaded when they actually have to be sent.
 
     :param query_result: Retrieve the photo from the database
     :return: The binary data of the photo
@@ -282,31 +314,97 @@ def retrieve_query_photo(query_result) -> bytes or None:
     try:
         assert query_result is not None
 
-        if query_result['photo'] == b'':
-            logger.info("Field 'photo' is empty")
-            return
-
         logger.info("Retrieving photo")
-        img = query_result['photo']
+        img = photo_store.load_photo(db, query_result)
+
+        if img is None:
+            logger.info("Photo is missing")
+
         return img
     except AssertionError:
         return
 
 
-def scan_barcode(image_bytes: io.BytesIO) -> str:
+def get_photo_input(context: CallbackContext, query_result) -> str or bytes or None:
     """
-    The scan_barcode function takes in an image file and returns the barcode contained within it.
+    The get_photo_input function returns what should be passed to reply_photo for a medicine document.
+    Telegram file IDs are only valid for the bot that received them, so they are stored per bot ID.
+    If this bot has already sent the photo, its file ID is returned and nothing has to be uploaded again.
 
-    :param image_bytes:io.BytesIO: Pass the image from the camera to the decode function
-    :return: The string representation of the barcode that it decodes
+    :param context: CallbackContext: Access the bot object
+    :param query_result: The medicine document
+    :return: The Telegram file ID or the binary data of the photo, None if the photo is missing
     """
+    if query_result is None:
+        return
+
+    file_id = query_result.get("photo_file_ids", {}).get(str(context.bot.id))
+    if file_id:
+        logger.info("Reusing Telegram file ID of the photo")
+        return file_id
+
+    return retrieve_query_photo(query_result)
+
 
+def remember_photo_file_id(context: CallbackContext, query_result, message) -> None:
+    """
+    The remember_photo_file_id function stores the file ID Telegram assigned to the photo sent in the message
+    next to the medicine document, so the next replies can send the file ID instead of the photo itself.
+
+    :param context: CallbackContext: Access the bot object
+    :param query_result: The medicine document whose photo was sent
+    :param message: Message: The message with the sent photo
+    :return: None
+    """
+    if not message.photo:
+        return
+
+    bot_id = str(context.bot.id)
+    file_id = message.photo[-1].file_id
+
+    if query_result.get("photo_file_ids", {}).get(bot_id) == file_id:
+        return
+
+    try:
+        collection.update_one({"code": query_result["code"]}, {"$set": {f"photo_file_ids.{bot_id}": file_id}})
+        query_cache.invalidate(query_result["code"])
+
+        logger.info("Stored Telegram file ID of the photo")
+    except Exception as e:
+        logger.error(e)
+
+
+def download_photo(context: CallbackContext, photo_size) -> bytes:
+    """
+    The download_photo function downloads the given size of a Telegram photo.
+
+    :param context: CallbackContext: Access the bot object
+    :param photo_size: PhotoSize: Size of the photo to download
+    :return: The binary data of the photo
+    """
+    image_bytes = io.BytesIO()
+    context.bot.getFile(photo_size.file_id).download(out=image_bytes)
+
+    return image_bytes.getvalue()
+
+
+def scan_barcode(context: CallbackContext, photos: list) -> str:
+    """
+    The scan_barcode function takes in a Telegram photo and returns the barcode contained within it.
+    A mid-size variant of the photo is downloaded first, the largest one is fetched only if decoding fails.
+    Decoding is done in the shared decoder process pool, which keeps the CPU-heavy work off the bot process,
+    but the calling thread still waits for the download and the result, up to DECODE_TIMEOUT.
+    The conversation handlers calling it, like get_name, run on the dispatcher thread, which is blocked meanwhile.
+
+    :param context: CallbackContext: Access the bot object to download the photo
+    :param photos: list: Sizes of the photo sent by the user
+    :return: The string representation of the barcode that it decodes
+    """
     logger.info("Trying to decode")
-    result = decode(Image.open(image_bytes))
+    barcode = barcode_decoder.decode_photo(photos, lambda photo_size: download_photo(context, photo_size))
 
-    assert result
+    assert barcode
 
-    barcode = result[0].data.decode("utf-8")
     return barcode
 
 
@@ -325,16 +423,12 @@ def retrieve_scan_results(update: Update, context: CallbackContext) -> None:
     logger.info("%s: Photo received", user.first_name)
 
     if update.message.photo:
-        id_img = update.message.photo[-1].file_id
+        photos = update.message.photo
     else:
         return
 
-    photo = context.bot.getFile(id_img)
-    image_bytes = io.BytesIO()
-    photo.download(out=image_bytes)
-
     try:
-        barcode = scan_barcode(image_bytes)
+        barcode = scan_barcode(context, photos)
     except AssertionError:
         logger.info("Failed to scan")
 
@@ -361,12 +455,12 @@ def retrieve_scan_results(update: Update, context: CallbackContext) -> None:
         reply_keyboard = [['Завершити сканування', 'Повідомити про проблему']]
 
         query_result = get_db_query_result(barcode)
-        photo = retrieve_query_photo(query_result)
+        photo = get_photo_input(context, query_result)
 
         if query_result and photo is not None:
             logger.info("The barcode is present in the database")
 
-            update.message.reply_photo(
+            message = update.message.reply_photo(
                 photo,
                 parse_mode='HTML',
                 reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True,
@@ -376,6 +470,7 @@ def retrieve_scan_results(update: Update, context: CallbackContext) -> None:
                         + ' наявний у моїй базі даних:\n\n' + format_query(query_result),
                 quote=True,
             )
+            remember_photo_file_id(context, query_result, message)
 
         elif query_result:
             logger.info("The barcode is present in the database but photo is missing")
@@ -405,7 +500,7 @@ def retrieve_scan_results(update: Update, context: CallbackContext) -> None:
                     input_field_placeholder='Продовжуйте',
                 ),
                 text='❌ Штрих-код ' + '<b>' + barcode + '</b>'
-                     + ' відсутній у моїй базі даних.\n\n'
+                     + ' відсутній у моїй базі даних.' + format_country(barcode) + '\n\n'
                        'Чи бажаєте Ви додати інформацію про цей медикамент?'
                        '\n\nДля зручності, ви можете знайти інформацію про цей медикамент у '
                        f'<a href="{link}"><b>Google</b></a>',
@@ -514,21 +609,11 @@ def get_name(update: Update, context: CallbackContext) -> int or None:
     :return: Ingredient state of conversation or None
     """
     if update.message.photo:
-        id_img = update.message.photo[-1].file_id
-        photo = context.bot.getFile(id_img)
-        image_bytes = io.BytesIO()
-        photo.download(out=image_bytes)
-
-        logger.info("Storing photo")
-
         try:
-            logger.info("Trying to decode")
-
-            result = decode(Image.open(image_bytes))
-            barcode = result[0].data.decode("utf-8")
+            barcode = scan_barcode(context, update.message.photo)
 
             logger.info("Decoded successfully")
-        except IndexError as e:
+        except AssertionError:
             logger.info("Failed to scan. Asking to retry")
 
             update.message.reply_text(
@@ -764,10 +849,11 @@ def check_info(update: Update, context: CallbackContext) -> int:
 
         photo.download(out=image_bytes)
         context.user_data["DRUG_INFO"]["photo"] = image_bytes.getvalue()
+        context.user_data["DRUG_INFO"]["photo_file_ids"] = {str(context.bot.id): id_img}
         logger.info("Storing photo")
 
         update.message.reply_photo(
-            image_bytes.getvalue(),
+            id_img,
             caption='<b>Введена інформація:</b>\n\n' + output
                     + '\n\n❓Ви точно бажаєте додати її до бази даних?',
             parse_mode='HTML',
@@ -793,7 +879,7 @@ def check_info(update: Update, context: CallbackContext) -> int:
             ),
         )
     else:
-        img = drug_info['photo']
+        img = drug_info.get("photo_file_ids", {}).get(str(context.bot.id), drug_info['photo'])
 
         update.message.reply_photo(
             img,
@@ -830,10 +916,47 @@ def insert_to_db(update: Update, context: CallbackContext) -> int or Conversatio
     if update.message.text == 'Так, додати до бази даних':
         user_id = update.effective_user.id
 
-        context.user_data["DRUG_INFO"]["user_id"] = user_id
-        context.user_data["DRUG_INFO"]["added_on"] = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+        # The document is built on a copy, so user_data keeps the photo and gets no photo_id or _id
+        # until the medicine is inserted, and a failed insert can be retried or changed
+        drug_info = dict(context.user_data["DRUG_INFO"])
+        drug_info["user_id"] = user_id
+        drug_info["added_on"] = datetime.now().strftime("%d/%m/%Y, %H:%M:%S")
+
+        photo_id = photo_store.store_photo(db, drug_info.pop("photo", b''))
+        if photo_id is not None:
+            drug_info["photo_id"] = photo_id
+
+        try:
+            collection.insert_one(drug_info)
+        except DuplicateKeyError:
+            # Someone else added this barcode since get_name checked it, e.g. another admin at the same time.
+            # Only the photo stored above is removed, the one of the medicine in the database is kept
+            if photo_id is not None:
+                photo_store.delete_photo(db, {"photo_id": photo_id})
+            query_cache.invalidate(drug_info["code"])
+            logger.info("Barcode %s is already in DB", drug_info["code"])
+
+            update.message.reply_text(
+                text='⚠️ Препарат з цим штрих-кодом вже є в базі даних',
+                reply_markup=ReplyKeyboardMarkup(
+                    reply_keyboard,
+                    one_time_keyboard=True,
+                    resize_keyboard=True,
+                    input_field_placeholder="Оберіть опцію",
+                ),
+            )
 
-        collection.insert_one(context.user_data["DRUG_INFO"])
+            context.user_data.pop("query", None)
+            context.user_data["DRUG_INFO"].clear()
+            return ConversationHandler.END
+        except PyMongoError:
+            # The photo is not referenced by any medicine, so it would stay in the bucket forever
+            if photo_id is not None:
+                photo_store.delete_photo(db, {"photo_id": photo_id})
+            raise
+
+        query_cache.invalidate(drug_info["code"])
+        statistics.record_added(drug_info["code"])
         logger.info("Checked info. Added to DB successfully")
 
         if "query" in context.user_data:
@@ -1283,9 +1406,9 @@ def add_admin(update: Update, context: CallbackContext) -> ConversationHandler.E
     else:
         return
 
-    face = find_faces(image_bytes.getvalue())
+    face = face_recognition.find_faces_batch([image_bytes.getvalue()])[0]
 
-    if face == 'Face not found':
+    if face is None or face == 'Face not found':
         logger.info("Face not found")
 
         update.message.reply_text(
@@ -1417,13 +1540,15 @@ def add_report_description(update: Update, context: CallbackContext) -> Conversa
 
     drug_info = context.user_data["DRUG_INFO"]
 
-    document = collection.find_one({"code": drug_info["code"]})
+    document = collection.find_one({"code": drug_info["code"]}, {"report": 1})
     if "report" in document:
         collection.update_one({"code": drug_info["code"]},
                               {"$set": {"report": document["report"] + f", [{user_id}]: " + report_description}})
     else:
         collection.update_one({"code": drug_info["code"]}, {"$set": {"report": f"[{user_id}]: " + report_description}})
 
+    query_cache.invalidate(drug_info["code"])
+
     logger.info("Reported successfully")
 
     update.message.reply_text(
@@ -1842,7 +1967,8 @@ def send_files(update: Update, context: CallbackContext) -> ConversationHandler.
 
     if update.message.text == 'Отримати додані медикаменти':
         medicine_by_user_id = list(
-            collection.find({"user_id": entered_id}, {"_id": 0, "photo": 0, "report": 0, "user_id": 0}))
+            collection.find({"user_id": entered_id}, {"_id": 0, "photo": 0, "photo_id": 0, "photo_file_ids": 0,
+                                                     "report": 0, "user_id": 0}))
 
         with open('data.json', 'w', encoding='utf-8') as f:
             json.dump(medicine_by_user_id, f, sort_keys=False, ensure_ascii=False, indent=4)
@@ -1863,8 +1989,8 @@ def send_files(update: Update, context: CallbackContext) -> ConversationHandler.
 
     if update.message.text == 'Отримати список скарг':
         medicine_by_user_id = list(collection.find({"user_id": entered_id, "report": {'$exists': 'true'}},
-                                                   {"_id": 0, "photo": 0, "user_id": 0, "active_ingredient": 0,
-                                                    "description": 0}))
+                                                   {"_id": 0, "photo": 0, "photo_id": 0, "photo_file_ids": 0,
+                                                    "user_id": 0, "active_ingredient": 0, "description": 0}))
 
         with open('data.json', 'w', encoding='utf-8') as f:
             json.dump(medicine_by_user_id, f, sort_keys=False, ensure_ascii=False, indent=4)
@@ -2060,12 +2186,7 @@ def send_plot(update: Update, context: CallbackContext) -> None:
     context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_PHOTO)
 
     not_empty_countries = statistics.get_not_empty_countries(quantities)
-    plot = statistics.get_bar_chart(not_empty_countries)
-
-    img_buf = io.BytesIO()
-    plot.savefig(img_buf, format='png')
-
-    img = img_buf.getvalue()
+    img = statistics.get_bar_chart_png(not_empty_countries)
 
     update.message.reply_photo(
         img,
@@ -2077,17 +2198,46 @@ def send_plot(update: Update, context: CallbackContext) -> None:
     loading_message.delete()
 
 
+@superuser
+@under_maintenance
+def rebuild_countries(update: Update, context: CallbackContext) -> None:
+    """
+    The rebuild_countries function recounts the medicines per country from the medicine collection
+    and overwrites the counters used by the countries statistics plot.
+
+    :param update: Update: Access the message object
+    :param context: CallbackContext: Send messages to the user
+    :return: None
+    """
+    logger.info("Rebuilding country counters")
+
+    quantities = statistics.rebuild_counters('resources/country_codes.json')
+
+    update.message.reply_text(
+        text="✅ Статистику по країнах перераховано"
+             f"\n\nМедикаментів з відомою країною: {sum(quantities.values())}",
+    )
+
+
 def main() -> None:
+    import_budget.report()
+
+    indexes.bootstrap(db)
+    statistics.ensure_counters('resources/country_codes.json')
+
     token = os.environ.get('msb_db_token')
     # port = int(os.environ.get('PORT', '8443'))
 
     updater = Updater(token)
     dispatcher = updater.dispatcher
 
+    updater.job_queue.run_repeating(database.log_pool_stats,
+                                    interval=int(os.environ.get('MONGO_METRICS_INTERVAL', 10 * 60)))
+
     scan = MessageHandler(Filters.regex('^(Перевірити наявність|/scan|Ще раз)$'), scan_handler)
     start = CommandHandler('start', start_handler)
     cancel_echo = CommandHandler('cancel', cancel_default)
-    decoder = MessageHandler(Filters.photo, retrieve_scan_results)
+    decoder = MessageHandler(Filters.photo, retrieve_scan_results, run_async=True)
     not_file = MessageHandler(Filters.attachment, file_warning)
     end_scan = MessageHandler(Filters.regex('^(Завершити сканування|Відмінити сканування|Зрозуміло!|Ні)$'),
                               main_keyboard_handler)
@@ -2206,10 +2356,12 @@ def main() -> None:
                    MessageHandler(Filters.text("Скасувати"), cancel_ban)]
     )
 
-    countries_statistics = CommandHandler('countries', send_plot)
+    countries_statistics = CommandHandler('countries', send_plot, run_async=True)
+    countries_rebuild = CommandHandler('rebuild_countries', rebuild_countries)
 
     dispatcher.add_handler(user_statistics)
     dispatcher.add_handler(countries_statistics)
+    dispatcher.add_handler(countries_rebuild)
     dispatcher.add_handler(register_handler)
     dispatcher.add_handler(report_handler)
     dispatcher.add_handler(feedback_handler)
@@ -2230,6 +2382,10 @@ def main() -> None:
     #                       webhook_url="https://telegram-medicine-search-bot.herokuapp.com/" + token)
     updater.idle()
 
+    barcode_decoder.shutdown()
+    face_recognition.shutdown()
+    database.close()
+
 
 if __name__ == '__main__':
     main()
@@ -2,9 +2,13 @@
 Author: Andrew Yaroshevych
 Version: 2.7.7 Development
 """
+# Imported first, so the time it takes to import the rest is measured
+from modules import import_budget
+
 import os
 import io
 import re
+import html
 import smtplib
 import logging
 from functools import wraps
@@ -19,8 +23,6 @@ import requests
 
 from dotenv import load_dotenv
 
-from pymongo import MongoClient
-
 from langdetect import detect
 
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, \
@@ -28,7 +30,10 @@ from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKe
 from telegram.ext import Updater, Filters, CallbackContext, CommandHandler, MessageHandler, CallbackQueryHandler, \
     ConversationHandler
 
-from modules.medicine_parser import find_info_tabletki_ua, find_info_drug_control
+from modules.medicine_parser import find_info, purge_caches
+from modules import barcode_decoder, photo_store, indexes, country_codes, database, scraper_pool, \
+    local_index
+from modules.cache import LRUCache, MISSING, document_size
 
 logging.basicConfig(
     format='%(asctime)s.%(msecs)03d - medicine_search_bot.py - %(name)s - %(funcName)s() - '
@@ -39,9 +44,7 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-cluster = MongoClient(os.environ.get('cluster'))
-
-db = cluster.TestBotDatabase
+db = database.get_database()
 collection = db.TestBotCollection
 
 # Conversation states
@@ -53,6 +56,14 @@ MAIN_REPLY_KEYBOARD = [['Сканувати', 'Пошук'], ['Інструкц
 
 UNDER_MAINTENANCE = os.environ.get('UNDER_MAINTENANCE') == "True"
 
+# Results of get_db_query_result by barcode. Writes made by this bot invalidate the entries,
+# the TTL bounds how long changes made by the other bot may stay unnoticed
+query_cache = LRUCache(
+    max_size=int(os.environ.get('DB_CACHE_BYTES', 32 * 1024 * 1024)),
+    ttl=float(os.environ.get('DB_CACHE_TTL', 120)),
+    size_of=document_size,
+)
+
 
 def under_maintenance(func):
     """
@@ -247,14 +258,22 @@ def goto_scan(update: Update, context: CallbackContext) -> None:
 def get_db_query_result(barcode) -> bool or None:
     """
     The get_db_query_result function takes a barcode as an argument and returns the result of a MongoDB query.
-    If no results are found, it returns None.
+    If no results are found, it returns None. Results are kept in query_cache, so popular barcodes
+    are answered without a round-trip to the database.
 
     :param barcode: Check if the barcode exists in the database
     :return: A dictionary with the product information if the barcode exists in the database
     """
+    query_result = query_cache.get(barcode, MISSING)
+    if query_result is not MISSING:
+        logger.info("Database query result found in cache")
+        return query_result
+
     try:
         logger.info("Database quired. Checking availability")
         query_result = collection.find_one({"code": barcode}, {"_id": 0})
+        query_cache.set(barcode, query_result)
+
         if query_result is None:
             return
 
@@ -289,9 +308,25 @@ def format_query(query_result) -> str or None:
         return
 
 
+def format_country(barcode) -> str:
+    """
+    The format_country function returns a line with the country of the GS1 organisation that issued the barcode.
+
+    :param barcode: Barcode to find the country for
+    :return: A formatted line or an empty string if the country is unknown
+    """
+    country = country_codes.get_country(barcode)
+
+    if country is None:
+        return ''
+
+    return f"\n🌍 Країна реєстрації штрих-коду: <b>{country}</b>"
+
+
 def retrieve_query_photo(query_result) -> bytes or None:
     """
-    The retrieve_query_photo function retrieves the photo from a query result.
+    The retrieve_query_photo function retrieves the photo of a query result.
+    Photos are kept in GridFS and only loaded when they actually have to be sent.
 
     :param query_result: Retrieve the photo from the database
     :return: The binary data of the photo
@@ -299,17 +334,66 @@ def retrieve_query_photo(query_result) -> bytes or None:
     try:
         assert query_result is not None
 
-        if query_result['photo'] == b'':
-            logger.info("Field 'photo' is empty")
-            return
-
         logger.info("Retrieving photo")
-        img = query_result['photo']
+        img = photo_store.load_photo(db, query_result)
+
+        if img is None:
+            logger.info("Photo is missing")
+
         return img
     except AssertionError:
         return
 
 
+def get_photo_input(context: CallbackContext, query_result) -> str or bytes or None:
+    """
+    The get_photo_input function returns what should be passed to reply_photo for a medicine document.
+    Telegram file IDs are only valid for the bot that received them, so they are stored per bot ID.
+    If this bot has already sent the photo, its file ID is returned and nothing has to be uploaded again.
+
+    :param context: CallbackContext: Access the bot object
+    :param query_result: The medicine document
+    :return: The Telegram file ID or the binary data of the photo, None if the photo is missing
+    """
+    if query_result is None:
+        return
+
+    file_id = query_result.get("photo_file_ids", {}).get(str(context.bot.id))
+    if file_id:
+        logger.info("Reusing Telegram file ID of the photo")
+        return file_id
+
+    return retrieve_query_photo(query_result)
+
+
+def remember_photo_file_id(context: CallbackContext, query_result, message) -> None:
+    """
+    The remember_photo_file_id function stores the file ID Telegram assigned to the photo sent in the message
+    next to the medicine document, so the next replies can send the file ID instead of the photo itself.
+
+    :param context: CallbackContext: Access the bot object
+    :param query_result: The medicine document whose photo was sent
+    :param message: Message: The message with the sent photo
+    :return: None
+    """
+    if not message.photo:
+        return
+
+    bot_id = str(context.bot.id)
+    file_id = message.photo[-1].file_id
+
+    if query_result.get("photo_file_ids", {}).get(bot_id) == file_id:
+        return
+
+    try:
+        collection.update_one({"code": query_result["code"]}, {"$set": {f"photo_file_ids.{bot_id}": file_id}})
+        query_cache.invalidate(query_result["code"])
+
+        logger.info("Stored Telegram file ID of the photo")
+    except Exception as e:
+        logger.error(e)
+
+
 def send_scanned_barcode_image(update: Update, bytes_image: io.BytesIO) -> None:
     """
     The send_scanned_barcode_image function takes an image and draws a rectangle around the detected barcode.
@@ -339,19 +423,36 @@ def send_scanned_barcode_image(update: Update, bytes_image: io.BytesIO) -> None:
     update.message.reply_photo(output.getvalue())
 
 
-def scan_barcode(image_bytes: io.BytesIO) -> str:
+def download_photo(context: CallbackContext, photo_size) -> bytes:
+    """
+    The download_photo function downloads the given size of a Telegram photo.
+
+    :param context: CallbackContext: Access the bot object
+    :param photo_size: PhotoSize: Size of the photo to download
+    :return: The binary data of the photo
     """
-    The scan_barcode function takes in an image file and returns the barcode contained within it.
+    image_bytes = io.BytesIO()
+    context.bot.getFile(photo_size.file_id).download(out=image_bytes)
+
+    return image_bytes.getvalue()
 
-    :param image_bytes:io.BytesIO: Pass the image from the camera to the decode function
+
+def scan_barcode(context: CallbackContext, photos: list) -> str:
+    """
+    The scan_barcode function takes in a Telegram photo and returns the barcode contained within it.
+    A mid-size variant of the photo is downloaded first, the largest one is fetched only if decoding fails.
+    Decoding is done in the shared decoder process pool, which keeps the CPU-heavy work off the bot process,
+    but the calling thread still waits for the download and the result, up to DECODE_TIMEOUT.
+
+    :param context: CallbackContext: Access the bot object to download the photo
+    :param photos: list: Sizes of the photo sent by the user
     :return: The string representation of the barcode that it decodes
     """
     logger.info("Trying to decode")
-    result = decode(Image.open(image_bytes))
+    barcode = barcode_decoder.decode_photo(photos, lambda photo_size: download_photo(context, photo_size))
 
-    assert result
+    assert barcode
 
-    barcode = result[0].data.decode("utf-8")
     return barcode
 
 
@@ -371,18 +472,12 @@ def retrieve_results(update: Update, context: CallbackContext) -> None:
     logger.info("%s: Photo received", user.first_name)
 
     if update.message.photo:
-        id_img = update.message.photo[-1].file_id
+        photos = update.message.photo
     else:
         return
 
-    photo = context.bot.getFile(id_img)
-    image_bytes = io.BytesIO()
-    photo.download(out=image_bytes)
-
-    # send_scanned_barcode_image(update, image_bytes)
-
     try:
-        barcode = scan_barcode(image_bytes)
+        barcode = scan_barcode(context, photos)
     except AssertionError:
         logger.info("Failed to scan. Asking to retry")
 
@@ -409,12 +504,12 @@ def retrieve_results(update: Update, context: CallbackContext) -> None:
         reply_keyboard = [['Завершити сканування', 'Повідомити про проблему']]
 
         query_result = get_db_query_result(barcode)
-        photo = retrieve_query_photo(query_result)
+        photo = get_photo_input(context, query_result)
 
         if query_result and photo is not None:
             logger.info("The barcode is present in the database")
 
-            update.message.reply_photo(
+            message = update.message.reply_photo(
                 photo,
                 parse_mode='HTML',
                 reply_markup=ReplyKeyboardMarkup(
@@ -423,9 +518,10 @@ def retrieve_results(update: Update, context: CallbackContext) -> None:
                     resize_keyboard=True,
                     input_field_placeholder='Продовжуйте',
                 ),
-                caption='Ось відсканований штрихкод ✅:\n' + '<b>' + barcode + '</b>' + "\n\n"
+                caption='Ось відсканований штрихкод ✅:\n' + '<b>' + barcode + '</b>' + format_country(barcode) + "\n\n"
                         + format_query(query_result),
             )
+            remember_photo_file_id(context, query_result, message)
 
         elif query_result:
             update.message.reply_text(
@@ -436,7 +532,7 @@ def retrieve_results(update: Update, context: CallbackContext) -> None:
                     resize_keyboard=True,
                     input_field_placeholder='Продовжуйте',
                 ),
-                text='Ось відсканований штрихкод ✅:\n' + '<b>' + barcode + '</b>' + "\n\n"
+                text='Ось відсканований штрихкод ✅:\n' + '<b>' + barcode + '</b>' + format_country(barcode) + "\n\n"
                      + format_query(query_result) + "\n\n⚠️ Фото відсутнє",
                 quote=True,
             )
@@ -452,7 +548,7 @@ def retrieve_results(update: Update, context: CallbackContext) -> None:
                     input_field_placeholder='Продовжуйте',
                 ),
                 text='Штрих-код ' + '<b>' + barcode + '</b>'
-                     + ' на жаль відсутній у моїй базі даних ❌'
+                     + ' на жаль відсутній у моїй базі даних ❌' + format_country(barcode) +
                        '\n\nЯкщо ви хочете долучитись до наповнення бази даних - '
                        'скористайтесь нашим другим ботом <b>@msb_database_bot</b>',
                 quote=True,
@@ -920,7 +1016,7 @@ def add_report_description(update: Update, context: CallbackContext) -> Conversa
 
     drug_code = context.user_data["DRUG_CODE"]
 
-    document = collection.find_one({"code": drug_code})
+    document = collection.find_one({"code": drug_code}, {"report": 1})
 
     if "report" in document:
         collection.update_one({"code": drug_code},
@@ -928,6 +1024,8 @@ def add_report_description(update: Update, context: CallbackContext) -> Conversa
     else:
         collection.update_one({"code": drug_code}, {"$set": {"report": f"[{user_id}]: " + report_description}})
 
+    query_cache.invalidate(drug_code)
+
     update.message.reply_text(
         text="✅️ Дякуємо. Ви успішно повідомили про проблему",
         reply_markup=ReplyKeyboardMarkup(
@@ -992,37 +1090,18 @@ def search_by_name(update: Update, context: CallbackContext) -> ConversationHand
     if not list(medicine_by_name):
         logger.info("Nothing is found")
 
-        data = find_info_tabletki_ua(query)
+        # The local medicine info answers most of the misses, the websites are only queried if it does not
+        found = local_index.find_info(query) or find_info(query)
 
-        if data:
+        if found:
+            source, data = found
+            # Instructions contain things like '< 90 мм рт. ст.' that break the HTML markup
+            data = {key: html.escape(value) if isinstance(value, str) else value for key, value in data.items()}
             url = data["link"]
 
             update.message.reply_text(
                 text=f'ℹ️ <b>Медикамент "{query}" відсутній у базі даних MSB</b>'
-                     f"\n\n<b><i>[Beta]</i></b> Ось інформація з ресурсу <a href=><b>tabletki.ua</b></a>"
-                     f"\n\n<b>Назва:</b> {data['name']}"
-                     f"\n<b>Діюча речовина:</b> {data['active_ingredient']}"
-                     f"\n<b>Фармгрупа:</b> {data['pharmgroup']}"
-                     f"\n<b>Показання:</b> {data['indication']}"
-                     f"\n<b>Протипоказання:</b> {data['contrandication']}",
-                parse_mode="HTML",
-                reply_markup=ReplyKeyboardMarkup(
-                    reply_keyboard,
-                    one_time_keyboard=True,
-                    resize_keyboard=True,
-                    input_field_placeholder='Оберіть опцію',
-                ),
-            )
-            return ConversationHandler.END
-
-        data = find_info_drug_control(query)
-
-        if data:
-            url = data["link"]
-
-            update.message.reply_text(
-                text=f'ℹ️ <b>Медикамент "{query}" відсутній у базі даних MSB</b>'
-                     f"\n\n<b><i>[Beta]</i></b> Ось інформація з ресурсу <a href=><b>likicontrol.com.ua</b></a>"
+                     f"\n\n<b><i>[Beta]</i></b> Ось інформація з ресурсу <a href=><b>{source}</b></a>"
                      f"\n\n<b>Назва:</b> {data['name']}"
                      f"\n<b>Діюча речовина:</b> {data['active_ingredient']}"
                      f"\n<b>Фармгрупа:</b> {data['pharmgroup']}"
@@ -1063,7 +1142,9 @@ def search_by_name(update: Update, context: CallbackContext) -> ConversationHand
                      f"\n<b>Діюча речовина</b>: {item['active_ingredient']} " \
                      f"\n<b>Опис</b>: {item['description']}"
 
-        if item["photo"] == b'':
+        img = get_photo_input(context, item)
+
+        if img is None:
             update.message.reply_text(
                 text='⚠️ Фото відсутнє\n\n' + str_output,
                 parse_mode="HTML",
@@ -1075,9 +1156,7 @@ def search_by_name(update: Update, context: CallbackContext) -> ConversationHand
                 ),
             )
         else:
-            img = item['photo']
-
-            update.message.reply_photo(
+            message = update.message.reply_photo(
                 img,
                 caption=str_output,
                 parse_mode="HTML",
@@ -1088,6 +1167,7 @@ def search_by_name(update: Update, context: CallbackContext) -> ConversationHand
                     input_field_placeholder='Оберіть опцію',
                 ),
             )
+            remember_photo_file_id(context, item, message)
 
     medicine_by_name.close()
     return ConversationHandler.END
@@ -1132,7 +1212,9 @@ def search_by_barcode(update: Update, context: CallbackContext) -> ConversationH
                  f"\n<b>Діюча речовина</b>: {medicine_by_barcode['active_ingredient']} " \
                  f"\n<b>Опис</b>: {medicine_by_barcode['description']}"
 
-    if medicine_by_barcode["photo"] == b'':
+    img = get_photo_input(context, medicine_by_barcode)
+
+    if img is None:
         update.message.reply_text(
             text='⚠️ Фото відсутнє\n\n' + str_output,
             parse_mode="HTML",
@@ -1144,9 +1226,7 @@ def search_by_barcode(update: Update, context: CallbackContext) -> ConversationH
             ),
         )
     else:
-        img = medicine_by_barcode['photo']
-
-        update.message.reply_photo(
+        message = update.message.reply_photo(
             img,
             caption=str_output,
             parse_mode="HTML",
@@ -1157,6 +1237,7 @@ def search_by_barcode(update: Update, context: CallbackContext) -> ConversationH
                 input_field_placeholder='Оберіть опцію',
             ),
         )
+        remember_photo_file_id(context, medicine_by_barcode, message)
 
     return ConversationHandler.END
 
@@ -1185,6 +1266,11 @@ def cancel_search(update: Update, context: CallbackContext) -> ConversationHandl
 
 
 def main() -> None:
+    import_budget.report()
+
+    indexes.bootstrap(db)
+    local_index.load_index()
+
     # noinspection SpellCheckingInspection
     token = os.environ.get('msb_token')
     # port = int(os.environ.get('PORT', '8443'))
@@ -1192,12 +1278,17 @@ def main() -> None:
     updater = Updater(token)
     dispatcher = updater.dispatcher
 
+    updater.job_queue.run_repeating(database.log_pool_stats,
+                                    interval=int(os.environ.get('MONGO_METRICS_INTERVAL', 10 * 60)))
+    updater.job_queue.run_repeating(purge_caches,
+                                    interval=int(os.environ.get('SCRAPE_CACHE_PURGE_INTERVAL', 24 * 60 * 60)), first=60)
+
     start = CommandHandler('start', start_handler)
     scan = MessageHandler(Filters.regex('^(Сканувати|/scan)$'), scan_handler)
     end_scan = MessageHandler(Filters.regex('^(Завершити сканування|Відмінити сканування)$'), end_scan_handler)
     instructions = MessageHandler(Filters.regex('^(Інструкції|/help)$'), instructions_handler)
     continue_scan = MessageHandler(Filters.regex('^(Зрозуміло!|Ще раз)$'), goto_scan)
-    decoder = MessageHandler(Filters.photo, retrieve_results)
+    decoder = MessageHandler(Filters.photo, retrieve_results, run_async=True)
     not_file = MessageHandler(Filters.attachment, file_warning)
     cancel = CommandHandler('cancel', cancel_operation)
     about = MessageHandler(Filters.regex('Про мене'), tell_about)
@@ -1264,6 +1355,10 @@ def main() -> None:
     #                       webhook_url="https://telegram-medicine-search-bot.herokuapp.com/" + token)
     updater.idle()
 
+    barcode_decoder.shutdown()
+    scraper_pool.shutdown()
+    database.close()
+
 
 if __name__ == '__main__':
     main()
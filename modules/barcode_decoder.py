@@ -0,0 +1,258 @@
+import io
+import os
+import logging
+import threading
+from typing import Callable
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageFilter
+from pyzbar.pyzbar import decode
+
+from dotenv import load_dotenv
+
+from modules.cache import LRUCache, MISSING
+from modules.process_pool import BoundedProcessPool
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Longest side of the first, downscaled decoding attempt
+DOWNSCALED_SIZE = 800
+# Longest side of the image used to look for the barcode region
+DETECTION_SIZE = 400
+# Regions covering more than this share of the image are not worth a separate attempt
+MAX_REGION_SHARE = 0.8
+# Longest side of the Telegram photo size downloaded first
+FIRST_TIER_SIZE = 800
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Decoded barcodes (None for photos without one) by Telegram file_unique_id of the photo
+decoded_photos = LRUCache(
+    max_size=int(os.environ.get('DECODE_CACHE_SIZE', 4096)),
+    ttl=float(os.environ.get('DECODE_CACHE_TTL', 24 * 60 * 60)),
+)
+
+
+def get_pool() -> BoundedProcessPool:
+    """
+    The get_pool function returns the process pool shared by both bots for barcode decoding.
+    The pool is configured with the DECODER_WORKERS and DECODER_MAX_PENDING environment variables
+    and is created on the first call.
+
+    Workers are started with "spawn", so each one is a new interpreter that imports the bot's main module
+    as __mp_main__, with telegram, pymongo and the rest of its imports. Both bots share one small dyno
+    whose os.cpu_count() reports the host's CPUs, so the default is a fixed 2 workers per bot.
+
+    :return: The shared BoundedProcessPool
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.environ.get('DECODER_WORKERS', 2))
+            max_pending = int(os.environ.get('DECODER_MAX_PENDING', workers * 4))
+
+            logger.info("Starting decoder pool: %s workers, %s pending tasks max", workers, max_pending)
+            _pool = BoundedProcessPool(max_workers=workers, max_pending=max_pending)
+
+        return _pool
+
+
+def _open_grayscale(image: bytes, max_side: int = None) -> Image.Image:
+    """
+    The _open_grayscale function opens the image in grayscale mode. If max_side is given, the image is scaled down
+    so that its longest side does not exceed it. For JPEG files the scaling is done while decoding,
+    so the full resolution bitmap is never allocated.
+
+    :param image: bytes: Encoded image
+    :param max_side: int: Longest side of the resulting image, None to keep the original size
+    :return: Grayscale PIL image
+    """
+    opened = Image.open(io.BytesIO(image))
+
+    if max_side is not None:
+        opened.draft("L", (max_side, max_side))
+
+    gray = opened.convert("L")
+
+    if max_side is not None:
+        gray.thumbnail((max_side, max_side))
+
+    return gray
+
+
+def _find_candidate_region(gray: Image.Image) -> tuple or None:
+    """
+    The _find_candidate_region function looks for the area of the image that most likely contains a barcode.
+    Barcodes are made of parallel bars, so their area has strong gradients in one direction and weak in the other.
+    The difference of the horizontal and vertical gradients is blurred and thresholded on a small copy of the image,
+    and the bounding box of the strongest rows and columns is mapped back to the original coordinates.
+
+    :param gray: Image.Image: Grayscale image
+    :return: A (left, top, right, bottom) box in the coordinates of gray or None if no distinct region was found
+    """
+    # Only the worker processes need numpy, the bots importing this module don't
+    import numpy as np
+
+    small = gray.copy()
+    small.thumbnail((DETECTION_SIZE, DETECTION_SIZE))
+
+    pixels = np.asarray(small, dtype=np.int16)
+    if pixels.shape[0] < 3 or pixels.shape[1] < 3:
+        return
+
+    gradient_x = np.abs(np.diff(pixels, axis=1))[:-1, :]
+    gradient_y = np.abs(np.diff(pixels, axis=0))[:, :-1]
+    energy = np.clip(np.abs(gradient_x - gradient_y), 0, 255).astype(np.uint8)
+
+    blurred = np.asarray(Image.fromarray(energy).filter(ImageFilter.BoxBlur(4)), dtype=np.float32)
+    mask = blurred > blurred.mean() + blurred.std()
+
+    row_weights = mask.sum(axis=1)
+    column_weights = mask.sum(axis=0)
+    if row_weights.max() == 0:
+        return
+
+    rows = np.flatnonzero(row_weights >= row_weights.max() / 2)
+    columns = np.flatnonzero(column_weights >= column_weights.max() / 2)
+
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = columns[0], columns[-1] + 1
+
+    pad_y = (bottom - top) // 5 + 2
+    pad_x = (right - left) // 5 + 2
+    top, bottom = max(top - pad_y, 0), min(bottom + pad_y, small.height)
+    left, right = max(left - pad_x, 0), min(right + pad_x, small.width)
+
+    if (bottom - top) * (right - left) > MAX_REGION_SHARE * small.width * small.height:
+        return
+
+    scale_x = gray.width / small.width
+    scale_y = gray.height / small.height
+
+    return (int(left * scale_x), int(top * scale_y),
+            int(right * scale_x), int(bottom * scale_y))
+
+
+def _candidates(image: bytes, skip_downscaled: bool = False):
+    """
+    The _candidates function yields the images to try decoding, from the cheapest to the most expensive:
+    a downscaled copy, the barcode region cropped from the full resolution image and the full image itself.
+
+    :param image: bytes: Encoded image
+    :param skip_downscaled: bool: Don't try the downscaled copy, e.g. when a photo of that size has already failed
+    :return: A generator of grayscale PIL images
+    """
+    if not skip_downscaled:
+        small = _open_grayscale(image, DOWNSCALED_SIZE)
+        yield small
+
+    full = _open_grayscale(image)
+    if not skip_downscaled and full.size == small.size:
+        return
+
+    region = _find_candidate_region(full)
+    if region is not None:
+        yield full.crop(region)
+
+    yield full
+
+
+def _decode(image: bytes, skip_downscaled: bool = False) -> str or None:
+    """
+    The _decode function runs in a worker process. It decodes the first barcode found on the image,
+    escalating from a downscaled copy to the full resolution only when the cheaper attempts fail.
+
+    :param image: bytes: Encoded image
+    :param skip_downscaled: bool: Start from the full resolution attempts
+    :return: The string representation of the barcode or None if nothing was decoded
+    """
+    for candidate in _candidates(image, skip_downscaled):
+        result = decode(candidate)
+
+        if result:
+            return result[0].data.decode("utf-8")
+
+    return
+
+
+def photo_tiers(photos: list) -> list:
+    """
+    The photo_tiers function picks the Telegram photo sizes to download, in order.
+    The first one is the smallest size with the longest side of at least FIRST_TIER_SIZE pixels,
+    the largest size is only used as a fallback.
+
+    :param photos: list: Sizes of the photo as sent by Telegram, from the smallest to the largest
+    :return: A list of one or two photo sizes
+    """
+    largest = photos[-1]
+
+    for photo in photos:
+        if max(photo.width, photo.height) >= FIRST_TIER_SIZE and photo is not largest:
+            return [photo, largest]
+
+    return [largest]
+
+
+def decode_photo(photos: list, download: Callable[[object], bytes]) -> str or None:
+    """
+    The decode_photo function decodes a Telegram photo, downloading a mid-size variant first
+    and fetching the largest one only if the barcode could not be decoded.
+    Results, including failures, are cached by the file_unique_id of the photo,
+    so resent and forwarded photos are neither downloaded nor decoded again.
+    Timeouts and crashed workers count as failed decodes but are not cached.
+
+    :param photos: list: Sizes of the photo as sent by Telegram, from the smallest to the largest
+    :param download: Callable that downloads a photo size and returns its bytes
+    :return: The string representation of the barcode or None if nothing was decoded
+    """
+    photo_id = photos[-1].file_unique_id
+
+    cached = decoded_photos.get(photo_id, MISSING)
+    if cached is not MISSING:
+        logger.info("Photo has already been decoded")
+        return cached
+
+    timeout = float(os.environ.get('DECODE_TIMEOUT', 30))
+
+    # A tier of at least DOWNSCALED_SIZE has already been tried at the size the next tier would be downscaled to
+    skip_downscaled = False
+
+    for photo in photo_tiers(photos):
+        try:
+            barcode = get_pool().run(_decode, download(photo), skip_downscaled, timeout=timeout)
+        except (TimeoutError, FutureTimeoutError):
+            logger.warning("Decoding timed out")
+            return
+        except BrokenProcessPool:
+            # A worker crashed, e.g. in zbar; the pool starts a new executor on the next submit
+            logger.error("Decoder worker crashed")
+            return
+
+        if barcode:
+            break
+
+        logger.info("Failed to decode %sx%s photo", photo.width, photo.height)
+        skip_downscaled = max(photo.width, photo.height) >= DOWNSCALED_SIZE
+    else:
+        barcode = None
+
+    decoded_photos.set(photo_id, barcode)
+    return barcode
+
+
+def shutdown() -> None:
+    """
+    The shutdown function stops the decoder worker processes.
+
+    :return: None
+    """
+    with _pool_lock:
+        pool = _pool
+
+    if pool is not None:
+        pool.shutdown()
@@ -0,0 +1,364 @@
+import json
+import time
+import logging
+import sqlite3
+import threading
+from functools import wraps
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import bson
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Returned by LRUCache.get when the key is absent, so cached None values can be told apart from misses
+MISSING = object()
+
+# Errors of the storage of the persistent caches, they are logged and the cache is bypassed
+CACHE_ERRORS = (sqlite3.Error, PyMongoError)
+
+
+class LRUCache:
+    """
+    The LRUCache class is a thread-safe least recently used cache with an optional time to live.
+    By default max_size limits the number of entries. If a size_of function is given, max_size limits
+    the total weight of the entries instead, e.g. their size in bytes.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None, size_of: Optional[Callable] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _weight(self, value) -> int:
+        return self.size_of(value) if self.size_of is not None else 1
+
+    def _remove(self, key) -> None:
+        _, _, weight = self._entries.pop(key)
+        self._size -= weight
+
+    def get(self, key, default=None):
+        """
+        The get function returns the cached value for the key and marks it as recently used.
+
+        :param key: Key of the entry
+        :param default: Value returned if the key is absent or expired
+        :return: The cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        """
+        The set function stores the value and evicts the least recently used entries
+        until the cache fits into max_size. Values heavier than max_size are not stored.
+
+        :param key: Key of the entry
+        :param value: Value to store
+        :return: None
+        """
+        weight = self._weight(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            if weight > self.max_size:
+                return
+
+            self._entries[key] = (value, expires_at, weight)
+            self._size += weight
+
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key) -> None:
+        """
+        The invalidate function removes the entry for the key, if there is one.
+
+        :param key: Key of the entry
+        :return: None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """
+        The clear function removes all entries.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def document_size(document: Optional[dict]) -> int:
+    """
+    The document_size function returns the size of a MongoDB document in bytes, as stored by the server.
+    It is meant to be used as size_of for caches of query results. Missing documents weigh a small constant.
+
+    :param document: The document or None
+    :return: The size of the BSON-encoded document
+    """
+    if document is None:
+        return 64
+
+    return len(bson.encode(document))
+
+
+class PersistentCache:
+    """
+    The PersistentCache class is a thread-safe cache stored in a table of an SQLite database, so its entries
+    survive restarts and are shared by the processes using the same file. Values must be JSON serializable.
+
+    Entries older than ttl are stale. Stale entries are still returned for stale_ttl more seconds,
+    so the caller can answer at once and refresh the value in the background. None values are cached
+    as negative results, they expire after negative_ttl.
+    """
+
+    def __init__(self, path: str, table: str, ttl: float, negative_ttl: Optional[float] = None,
+                 stale_ttl: float = 0):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.stale_ttl = stale_ttl
+
+        self._connection = None
+        self._lock = threading.Lock()
+
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._connection.commit()
+
+        return self._connection
+
+    def lookup(self, key: str) -> tuple:
+        """
+        The lookup function returns the cached value for the key and whether it is still fresh.
+
+        :param key: str: Key of the entry
+        :return: A tuple of the value and True if it is fresh, False if it is stale.
+                 The value is MISSING if the key is absent or expired
+        """
+        with self._lock:
+            row = self._get_connection().execute(
+                f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return MISSING, False
+
+        return self._check(json.loads(row[0]), row[1])
+
+    def _check(self, value, stored_at: float) -> tuple:
+        age = time.time() - stored_at
+        ttl = self.ttl if value is not None else self.negative_ttl
+
+        if age > ttl + self.stale_ttl:
+            return MISSING, False
+
+        return value, age <= ttl
+
+    def set(self, key: str, value) -> None:
+        """
+        The set function stores the value for the key.
+
+        :param key: str: Key of the entry
+        :param value: A JSON serializable value, None for a negative result
+        :return: None
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), time.time())
+            )
+            connection.commit()
+
+    def invalidate(self, key: str) -> None:
+        """
+        The invalidate function removes the entry for the key, if there is one.
+
+        :param key: str: Key of the entry
+        :return: None
+        """
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            connection.commit()
+
+    def purge(self) -> int:
+        """
+        The purge function removes the entries that are too old to be returned even as stale.
+
+        :return: The number of removed entries
+        """
+        now = time.time()
+
+        with self._lock:
+            connection = self._get_connection()
+            removed = connection.execute(
+                f"DELETE FROM {self.table} WHERE (value = 'null' AND stored_at < ?) OR stored_at < ?",
+                (now - self.negative_ttl - self.stale_ttl, now - self.ttl - self.stale_ttl)
+            ).rowcount
+            connection.commit()
+
+        return removed
+
+    def refresh(self, key: str, load: Callable) -> None:
+        """
+        The refresh function stores the value returned by load for the key in a background thread.
+        If the key is already being refreshed, nothing is done.
+
+        :param key: str: Key of the entry
+        :param load: A function without arguments returning the new value
+        :return: None
+        """
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run() -> None:
+            try:
+                self.set(key, load())
+            except Exception as e:
+                logger.warning("Failed to refresh %s in %s: %s", key, self.table, e)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f"refresh-{self.table}", daemon=True).start()
+
+
+class MongoCache(PersistentCache):
+    """
+    The MongoCache class is a PersistentCache whose entries are stored in a MongoDB collection instead of
+    an SQLite file, for hosts whose disk does not survive a restart, like Heroku dynos. The caches share
+    the collection, their entries are told apart by the table field. Values must be JSON serializable.
+    """
+
+    def __init__(self, collection: Collection, table: str, ttl: float, negative_ttl: Optional[float] = None,
+                 stale_ttl: float = 0):
+        super().__init__(collection.full_name, table, ttl, negative_ttl=negative_ttl, stale_ttl=stale_ttl)
+        self.collection = collection
+
+    def lookup(self, key: str) -> tuple:
+        document = self.collection.find_one({"table": self.table, "key": key}, {"_id": 0, "value": 1, "stored_at": 1})
+
+        if document is None:
+            return MISSING, False
+
+        return self._check(json.loads(document["value"]), document["stored_at"])
+
+    def set(self, key: str, value) -> None:
+        self.collection.update_one(
+            {"table": self.table, "key": key},
+            {"$set": {"value": json.dumps(value, ensure_ascii=False), "stored_at": time.time()}},
+            upsert=True,
+        )
+
+    def invalidate(self, key: str) -> None:
+        self.collection.delete_one({"table": self.table, "key": key})
+
+    def purge(self) -> int:
+        now = time.time()
+
+        return self.collection.delete_many({"table": self.table, "$or": [
+            {"value": "null", "stored_at": {"$lt": now - self.negative_ttl - self.stale_ttl}},
+            {"stored_at": {"$lt": now - self.ttl - self.stale_ttl}},
+        ]}).deleted_count
+
+
+def normalize_query(query: str) -> str:
+    """
+    The normalize_query function brings a search query to the form used as a cache key:
+    lowercase, without leading, trailing and repeated whitespace.
+
+    :param query: str: The search query
+    :return: The normalized query
+    """
+    return " ".join(query.lower().split())
+
+
+def persistent_cached(cache: PersistentCache, key: Callable = normalize_query) -> Callable:
+    """
+    The persistent_cached function is a decorator for functions of a single argument that caches their results
+    in a PersistentCache or a MongoCache. Stale results are returned at once and refreshed in the background.
+    Exceptions are not cached. The original function stays available as __wrapped__ to get a fresh result.
+
+    :param cache: PersistentCache: The cache to store the results in
+    :param key: Callable: Turns the argument into the cache key
+    :return: The decorator
+    """
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(argument):
+            cache_key = key(argument)
+
+            try:
+                value, fresh = cache.lookup(cache_key)
+            except CACHE_ERRORS as e:
+                logger.error("Failed to read %s from %s: %s", cache_key, cache.table, e)
+                return function(argument)
+
+            if value is not MISSING:
+                if not fresh:
+                    cache.refresh(cache_key, lambda: function(argument))
+                return value
+
+            value = function(argument)
+
+            try:
+                cache.set(cache_key, value)
+            except CACHE_ERRORS as e:
+                logger.error("Failed to store %s in %s: %s", cache_key, cache.table, e)
+
+            return value
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,79 @@
+import json
+from bisect import bisect_right
+from functools import lru_cache
+
+COUNTRY_CODES_PATH = 'resources/country_codes.json'
+
+
+@lru_cache(maxsize=None)
+def load_prefix_index(path: str = COUNTRY_CODES_PATH) -> tuple:
+    """
+    The load_prefix_index function reads the GS1 country codes from a json file and compiles them into
+    a list of (first prefix, last prefix, country) intervals sorted by the first prefix, plus the list of
+    the first prefixes used for binary search. Keys of the file are either a single prefix ("482")
+    or an inclusive range ("400–440"). The index is built once per path.
+
+    :param path: Specify the path to the json file containing the country codes
+    :return: A tuple of the sorted first prefixes and the sorted intervals
+    """
+    with open(path) as json_file:
+        country_codes = json.load(json_file)
+
+    intervals = list()
+
+    for key, value in country_codes.items():
+        key_splitted = key.split("–")
+        intervals.append((int(key_splitted[0]), int(key_splitted[-1]), value))
+
+    intervals.sort()
+    starts = [start for start, _, _ in intervals]
+
+    return starts, intervals
+
+
+def get_countries(path: str = COUNTRY_CODES_PATH) -> list:
+    """
+    The get_countries function returns the names of all countries from the country codes file, without duplicates.
+
+    :param path: Specify the path to the json file containing the country codes
+    :return: A list of country names in the order of their prefixes
+    """
+    _, intervals = load_prefix_index(path)
+    return list(dict.fromkeys(country for _, _, country in intervals))
+
+
+def get_country_by_prefix(prefix: int, path: str = COUNTRY_CODES_PATH) -> str or None:
+    """
+    The get_country_by_prefix function finds the country a 3-digit GS1 prefix is assigned to.
+
+    :param prefix: int: The first three digits of a barcode
+    :param path: Specify the path to the json file containing the country codes
+    :return: The name of the country or None if the prefix is not assigned to any country
+    """
+    starts, intervals = load_prefix_index(path)
+
+    position = bisect_right(starts, prefix) - 1
+    if position < 0:
+        return
+
+    _, end, country = intervals[position]
+    if prefix > end:
+        return
+
+    return country
+
+
+def get_country(barcode: str, path: str = COUNTRY_CODES_PATH) -> str or None:
+    """
+    The get_country function finds the country of the GS1 member organisation that issued the barcode.
+
+    :param barcode: str: EAN-13 or EAN-8 barcode
+    :param path: Specify the path to the json file containing the country codes
+    :return: The name of the country or None if it can't be determined
+    """
+    prefix = barcode[:3]
+
+    if len(prefix) < 3 or not prefix.isdigit():
+        return
+
+    return get_country_by_prefix(int(prefix), path)
@@ -0,0 +1,158 @@
+import os
+import logging
+import threading
+
+from pymongo import MongoClient, monitoring
+from pymongo.database import Database
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    The PoolMetrics class counts the connection pool events of the shared MongoDB client:
+    how many connections were opened and closed, how many checkouts were made or failed,
+    and how many connections are in use right now and at most.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        logger.warning("Connection pool for %s cleared", event.address)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failed += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def snapshot(self) -> dict:
+        """
+        The snapshot function returns the current values of the counters.
+
+        :return: A dictionary with the counter names as keys
+        """
+        with self._lock:
+            return {
+                "open": self.created - self.closed,
+                "created": self.created,
+                "closed": self.closed,
+                "checked_out": self.checked_out,
+                "checkout_failed": self.checkout_failed,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    """
+    The get_client function returns the MongoDB client shared by all the modules of a bot process.
+    It is created on the first call and does not connect until the first operation.
+    The pool and the timeouts can be tuned with the MONGO_* environment variables.
+
+    :return: The shared MongoClient
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(
+                os.environ.get('cluster'),
+                maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', 20)),
+                minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+                maxIdleTimeMS=int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 5 * 60 * 1000)),
+                connectTimeoutMS=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+                serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000)),
+                socketTimeoutMS=int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 20000)),
+                waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+                readPreference=os.environ.get('MONGO_READ_PREFERENCE', 'primaryPreferred'),
+                retryWrites=True,
+                connect=False,
+                event_listeners=[pool_metrics],
+            )
+
+        return _client
+
+
+def get_database() -> Database:
+    """
+    The get_database function returns the bot database from the shared client.
+
+    :return: The bot database
+    """
+    return get_client().TestBotDatabase
+
+
+def log_pool_stats(context=None) -> None:
+    """
+    The log_pool_stats function logs the connection pool metrics.
+    It can be scheduled as a job of the Telegram job queue.
+
+    :param context: CallbackContext: Unused, passed by the job queue
+    :return: None
+    """
+    logger.info("MongoDB pool: %s", pool_metrics.snapshot())
+
+
+def close() -> None:
+    """
+    The close function closes the shared client and its connections.
+
+    :return: None
+    """
+    global _client
+
+    with _client_lock:
+        client, _client = _client, None
+
+    if client is not None:
+        client.close()
@@ -1,5 +1,77 @@
-import cv2
-import numpy as np
+import os
+import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from dotenv import load_dotenv
+
+from modules.process_pool import BoundedProcessPool
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# cv2 and numpy are imported on first use, only the admin registration needs them
+
+# Longest side of the downscaled image faces are looked for first
+DETECTION_SIZE = 640
+# Seconds to wait for a single image of a batch
+FACE_TIMEOUT = float(os.environ.get('FACE_TIMEOUT', 30))
+
+_face_cascade = None
+# Guards both loading and using the classifier, which is not safe to share between threads
+_face_cascade_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> BoundedProcessPool:
+    """
+    The get_pool function returns the process pool used for face detection.
+    The pool is configured with the FACE_WORKERS and FACE_MAX_PENDING environment variables
+    and is created on the first call.
+
+    :return: The face detection BoundedProcessPool
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.environ.get('FACE_WORKERS', 1))
+            max_pending = int(os.environ.get('FACE_MAX_PENDING', workers * 4))
+
+            logger.info("Starting face detection pool: %s workers, %s pending tasks max", workers, max_pending)
+            _pool = BoundedProcessPool(max_workers=workers, max_pending=max_pending)
+
+        return _pool
+
+
+def _get_face_cascade():
+    """
+    The _get_face_cascade function returns the frontal face Haar cascade classifier,
+    loading it from disk only on the first call in the process.
+
+    :return: cv2.CascadeClassifier
+    """
+    global _face_cascade
+
+    import cv2
+
+    if _face_cascade is None:
+        _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+    return _face_cascade
+
+
+def _detect_faces(gray, min_size: int):
+    with _face_cascade_lock:
+        return _get_face_cascade().detectMultiScale(
+            gray,
+            scaleFactor=1.3,
+            minNeighbors=3,
+            minSize=(min_size, min_size)
+        )
 
 
 def find_faces(bytes_image: bytes) -> str or bytes:
@@ -8,21 +80,34 @@ def find_faces(bytes_image: bytes) -> str or bytes:
     and returns either 'Too many faces' or 'Face not found' if more than one face is detected or if no face is found
     respectively. If exactly one face is found then it will return the cropped version of that single face.
 
+    Faces are looked for on a copy downscaled to DETECTION_SIZE first and the found box is mapped back
+    to the original image. The full resolution image is only searched if nothing was found on the copy.
+
     :param bytes_image :bytes: Pass the image as bytes to the function
     :return: A string if there is more than one or zero faces in the image, a bytes object otherwise
     """
+    import cv2
+    import numpy as np
+
     image_as_np = np.frombuffer(bytes_image, dtype=np.uint8)
 
     cv2_image = cv2.imdecode(image_as_np, flags=1)
     gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
 
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-    faces = face_cascade.detectMultiScale(
-        gray,
-        scaleFactor=1.3,
-        minNeighbors=3,
-        minSize=(30, 30)
-    )
+    height, width = gray.shape
+    scale = min(1.0, DETECTION_SIZE / max(height, width))
+
+    faces = []
+
+    if scale < 1.0:
+        small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        faces = [
+            (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+            for (x, y, w, h) in _detect_faces(small, max(20, int(30 * scale)))
+        ]
+
+    if len(faces) == 0:
+        faces = _detect_faces(gray, 30)
 
     if len(faces) == 0:
         return 'Face not found'
@@ -31,3 +116,102 @@ def find_faces(bytes_image: bytes) -> str or bytes:
             face = cv2_image[y:y + h + 5, x:x + w + 5]
             output_bytes = cv2.imencode('.jpg', face)[1].tobytes()
             return output_bytes
+
+
+def find_faces_batch(images: list, timeout: float = FACE_TIMEOUT) -> list:
+    """
+    The find_faces_batch function runs find_faces on each of the images in the face detection process pool.
+    The images are submitted as the pool frees up, so a big batch does not pile up in memory.
+
+    :param images: list: Images as bytes objects
+    :param timeout: float: Seconds to wait for each image
+    :return: A list with the result of find_faces for every image, in the same order,
+             None for the images that could not be processed in time or failed to decode
+    """
+    pool = get_pool()
+    futures = list()
+
+    for image in images:
+        try:
+            futures.append(pool.submit(find_faces, image, timeout=timeout))
+        except TimeoutError:
+            logger.warning("Face detection pool is saturated, skipping image")
+            futures.append(None)
+
+    results = list()
+
+    for future in futures:
+        if future is None:
+            results.append(None)
+            continue
+
+        try:
+            results.append(future.result(timeout=timeout))
+        except FutureTimeoutError:
+            logger.warning("Face detection timed out")
+            results.append(None)
+        except Exception as e:
+            logger.error("Face detection failed: %s", e)
+            results.append(None)
+
+    return results
+
+
+def verify_admin_photos(collection, batch_size: int = 16) -> list:
+    """
+    The verify_admin_photos function checks that a face can still be found on the photo of every administrator.
+
+    :param collection: Collection: The administrators collection
+    :param batch_size: int: Number of photos loaded and checked at once
+    :return: A list of user IDs of the administrators whose photos failed the check
+    """
+    failed = list()
+    batch = list()
+
+    def check(admins: list) -> None:
+        results = find_faces_batch([admin.get("photo") or b"" for admin in admins])
+
+        for admin, result in zip(admins, results):
+            if result is None or result == 'Face not found':
+                logger.warning("Face not found on the photo of admin %s", admin.get("user_id"))
+                failed.append(admin.get("user_id"))
+            else:
+                logger.info("Photo of admin %s is fine", admin.get("user_id"))
+
+    for admin in collection.find({}, {"user_id": 1, "photo": 1}):
+        batch.append(admin)
+
+        if len(batch) == batch_size:
+            check(batch)
+            batch = list()
+
+    if batch:
+        check(batch)
+
+    return failed
+
+
+def shutdown() -> None:
+    """
+    The shutdown function stops the face detection worker processes.
+
+    :return: None
+    """
+    with _pool_lock:
+        pool = _pool
+
+    if pool is not None:
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    from modules.database import get_database
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        failed_admins = verify_admin_photos(get_database().Administrators)
+    finally:
+        shutdown()
+
+    print(f"Done. {len(failed_admins)} administrators without a recognizable face: {failed_admins}")
@@ -0,0 +1,95 @@
+import sys
+import time
+
+import bs4
+
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+
+def _has_class(attrs: dict, class_name: str) -> bool:
+    classes = attrs.get("class") or ""
+    if isinstance(classes, str):
+        classes = classes.split()
+
+    return class_name in classes
+
+
+def _tabletki_search(name: str, attrs: dict) -> bool:
+    if name != "div":
+        return False
+
+    return attrs.get("id") == "sku_0" \
+        or _has_class(attrs, "page-not-found__message") \
+        or _has_class(attrs, "carousel-simple-item")
+
+
+def _tabletki_medicine(name: str, attrs: dict) -> bool:
+    return name == "div" and attrs.get("id") in ("instr_cont_0", "instr_cont_2", "instr_cont_4", "instr_cont_5")
+
+
+# Parts of the pages the scrapers read: page kind -> SoupStrainer, None to parse the whole page.
+# The likicontrol.com.ua instruction page is read by walking parents and siblings of the labels,
+# so it can't be cut down and only benefits from the faster parser.
+PAGE_STRAINERS = {
+    "tabletki_search": bs4.SoupStrainer(_tabletki_search),
+    "tabletki_medicine": bs4.SoupStrainer(_tabletki_medicine),
+    "likicontrol_search": bs4.SoupStrainer("a"),
+    "likicontrol_medicine": None,
+}
+
+
+def parse(markup: str, page: str = None) -> bs4.BeautifulSoup:
+    """
+    The parse function builds the tree of an HTML page with the fastest parser available, lxml if it is installed
+    and html.parser otherwise. If the page kind is given, only the elements its scraper reads are kept.
+
+    :param markup: str: The HTML of the page
+    :param page: str: A key of PAGE_STRAINERS, None to parse the whole page
+    :return: The parsed page
+    """
+    strainer = PAGE_STRAINERS[page] if page is not None else None
+
+    return bs4.BeautifulSoup(markup, PARSER, parse_only=strainer)
+
+
+def benchmark(page: str, paths: list, repeat: int = 20) -> dict:
+    """
+    The benchmark function compares the time it takes to parse saved pages fully with html.parser,
+    which is what the scrapers used to do, and with the parse function.
+
+    :param page: str: A key of PAGE_STRAINERS the saved pages belong to
+    :param paths: list: Paths to the saved HTML pages
+    :param repeat: int: Number of times each page is parsed
+    :return: A dictionary with the average parse time in milliseconds for both ways
+    """
+    pages = list()
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            pages.append(file.read())
+
+    def measure(parse_page) -> float:
+        started = time.perf_counter()
+
+        for _ in range(repeat):
+            for markup in pages:
+                parse_page(markup)
+
+        return (time.perf_counter() - started) * 1000 / (repeat * len(pages))
+
+    return {
+        "html.parser": measure(lambda markup: bs4.BeautifulSoup(markup, "html.parser")),
+        f"{PARSER}, {page}": measure(lambda markup: parse(markup, page)),
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in PAGE_STRAINERS:
+        print(f"Usage: python -m modules.html_extract <{'|'.join(PAGE_STRAINERS)}> <page.html> [page.html ...]")
+        sys.exit(1)
+
+    for way, milliseconds in benchmark(sys.argv[1], sys.argv[2:]).items():
+        print(f"{way}: {milliseconds:.2f} ms per page")
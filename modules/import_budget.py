@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Modules that take long to import and should only be loaded when a command needs them
+HEAVY_MODULES = ("pandas", "matplotlib", "seaborn", "cv2", "numpy")
+
+# Taken when the module is imported, the bots import it before their other dependencies
+STARTED = time.perf_counter()
+
+
+def report(started: float = STARTED) -> None:
+    """
+    The report function logs how long the bot took to import its dependencies and which of the heavy modules
+    have been loaded. If the time exceeds IMPORT_BUDGET_MS (1500 ms by default), a warning is logged.
+
+    :param started: float: time.perf_counter() value taken before the first import, STARTED by default
+    :return: None
+    """
+    elapsed = (time.perf_counter() - started) * 1000
+    budget = float(os.environ.get('IMPORT_BUDGET_MS', 1500))
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    if elapsed > budget:
+        logger.warning("Imports took %.0f ms, over the budget of %.0f ms", elapsed, budget)
+    else:
+        logger.info("Imports took %.0f ms, budget is %.0f ms", elapsed, budget)
+
+    if loaded:
+        logger.warning("Heavy modules loaded at startup: %s", ", ".join(loaded))
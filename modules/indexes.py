@@ -0,0 +1,144 @@
+import logging
+
+from pymongo import ASCENDING, TEXT
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Indexes the bots rely on: collection name -> list of (index name, keys, options)
+REQUIRED_INDEXES = {
+    "TestBotCollection": [
+        ("code_unique", [("code", ASCENDING)], {"unique": True}),
+        ("user_id", [("user_id", ASCENDING)], {}),
+        ("name_ingredient_text", [("name", TEXT), ("active_ingredient", TEXT)], {"default_language": "none"}),
+    ],
+    "Administrators": [
+        ("user_id", [("user_id", ASCENDING)], {}),
+    ],
+    "Blacklist": [
+        ("user_id", [("user_id", ASCENDING)], {}),
+    ],
+    # Used by the scrape caches of medicine_parser when SCRAPE_CACHE_BACKEND is "mongodb"
+    "ScrapeCache": [
+        ("table_key_unique", [("table", ASCENDING), ("key", ASCENDING)], {"unique": True}),
+        ("table_stored_at", [("table", ASCENDING), ("stored_at", ASCENDING)], {}),
+    ],
+}
+
+# Hot queries whose plans are checked at startup: (collection name, filter)
+HOT_QUERIES = [
+    ("TestBotCollection", {"code": "4820000000000"}),
+    ("TestBotCollection", {"user_id": 0}),
+    ("TestBotCollection", {"$text": {"$search": "парацетамол"}}),
+    ("Administrators", {"user_id": 0}),
+    ("Blacklist", {"user_id": 0}),
+]
+
+
+def _same_keys(index_info: dict, keys: list) -> bool:
+    """
+    The _same_keys function checks whether an existing index covers the given keys.
+    Text indexes are reported by the server as _fts/_ftsx keys with the fields in the weights option.
+
+    :param index_info: dict: Description of an existing index from index_information()
+    :param keys: list: Keys of the required index
+    :return: True if the existing index has the same keys
+    """
+    existing_keys = list(index_info["key"])
+
+    if any(direction == TEXT for _, direction in keys):
+        return "weights" in index_info and set(index_info["weights"]) == {field for field, _ in keys}
+
+    # Text and other special indexes have string directions, e.g. ("_fts", "text"), and never match plain keys
+    if any(isinstance(direction, str) for _, direction in existing_keys):
+        return False
+
+    return [(field, int(direction)) for field, direction in existing_keys] == keys
+
+
+def _find_index(existing: dict, keys: list) -> str or None:
+    for name, index_info in existing.items():
+        if _same_keys(index_info, keys):
+            return name
+
+    return
+
+
+def ensure_indexes(database: Database) -> None:
+    """
+    The ensure_indexes function creates the indexes from REQUIRED_INDEXES that do not exist yet
+    and checks that the existing ones match the declaration. Problems are logged, not raised,
+    so a bot can still start with an incomplete set of indexes.
+
+    :param database: Database: The bot database
+    :return: None
+    """
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = database[collection_name]
+        existing = collection.index_information()
+
+        for name, keys, options in indexes:
+            existing_name = _find_index(existing, keys)
+
+            if existing_name is not None:
+                if options.get("unique") and not existing[existing_name].get("unique"):
+                    logger.warning("Index %s.%s exists but is not unique", collection_name, existing_name)
+                else:
+                    logger.info("Index %s.%s is present", collection_name, existing_name)
+                continue
+
+            try:
+                collection.create_index(keys, name=name, **options)
+                logger.info("Created index %s.%s", collection_name, name)
+            except OperationFailure as e:
+                logger.error("Failed to create index %s.%s: %s", collection_name, name, e)
+
+
+def _winning_stages(plan: dict) -> list:
+    stages = [plan.get("stage")]
+
+    if "inputStage" in plan:
+        stages += _winning_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        stages += _winning_stages(input_stage)
+
+    return stages
+
+
+def log_query_plans(database: Database) -> None:
+    """
+    The log_query_plans function logs the winning plan of each query from HOT_QUERIES
+    and warns about the ones that fall back to a collection scan.
+
+    :param database: Database: The bot database
+    :return: None
+    """
+    for collection_name, query in HOT_QUERIES:
+        try:
+            explanation = database[collection_name].find(query).limit(1).explain()
+        except OperationFailure as e:
+            logger.error("Failed to explain %s on %s: %s", query, collection_name, e)
+            continue
+
+        stages = _winning_stages(explanation["queryPlanner"]["winningPlan"])
+
+        if "COLLSCAN" in stages:
+            logger.warning("Query %s on %s uses a collection scan", query, collection_name)
+        else:
+            logger.info("Query %s on %s: %s", query, collection_name, " <- ".join(stages))
+
+
+def bootstrap(database: Database) -> None:
+    """
+    The bootstrap function prepares the database at bot startup:
+    it makes sure the required indexes exist and logs the query plans of the hot queries.
+
+    :param database: Database: The bot database
+    :return: None
+    """
+    try:
+        ensure_indexes(database)
+        log_query_plans(database)
+    except Exception as e:
+        logger.error("Index bootstrap failed: %s", e)
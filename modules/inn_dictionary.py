@@ -0,0 +1,138 @@
+import re
+import json
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+MEDICINE_INFO_PATH = 'resources/medicine_info.json'
+
+# Cyrillic letters that look like Latin ones and get mixed into Latin names, e.g. 'Аmbroxol', 'Acіclovir'
+HOMOGLYPHS = str.maketrans("АаВЕеІіКМНОоРрСсТуХх", "AaBEeIiKMHOoPpCcTyXx")
+
+# Rough Latin to Ukrainian transliteration, only used to check that a name is a transcription of an INN
+TRANSLITERATION = [
+    ("ph", "ф"), ("th", "т"), ("ch", "х"), ("ce", "це"), ("ci", "ці"), ("cy", "ці"), ("x", "кс"),
+    ("a", "а"), ("b", "б"), ("c", "к"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"), ("h", "г"),
+    ("i", "і"), ("j", "й"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"),
+    ("q", "к"), ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("v", "в"), ("w", "в"), ("y", "і"),
+    ("z", "з"),
+]
+
+# Minimal similarity of a Ukrainian name to the transliterated INN for them to be paired
+MIN_SIMILARITY = 0.75
+# Minimal ratio of the lengths of the name and the transliterated INN, brand names are often cut INNs ('кандесар')
+MIN_LENGTH_RATIO = 0.85
+
+_LATIN_WORD = re.compile(r"^[a-z]+$")
+_CYRILLIC_WORD = re.compile(r"^[а-щьюяєіїґ']+$")
+_NAME_WITH_LATIN = re.compile(r"^([^\W\d_]+)\s*\(([^\W\d_]+)\)$")
+
+
+def normalize_latin(word: str) -> str:
+    """
+    The normalize_latin function lowercases a word written in Latin letters and replaces
+    the Cyrillic homoglyphs mixed into it with the Latin letters they look like.
+
+    :param word: str: The word to normalize
+    :return: The normalized word
+    """
+    return word.strip().translate(HOMOGLYPHS).lower()
+
+
+def transliterate(word: str) -> str:
+    """
+    The transliterate function transcribes a lowercase Latin word into Ukrainian letters.
+
+    :param word: str: Lowercase Latin word
+    :return: The transcription
+    """
+    result = ''
+    position = 0
+
+    while position < len(word):
+        for latin, cyrillic in TRANSLITERATION:
+            if word.startswith(latin, position):
+                result += cyrillic
+                position += len(latin)
+                break
+        else:
+            result += word[position]
+            position += 1
+
+    return result
+
+
+def _similarity(inn: str, name: str) -> float:
+    # Latin i and y are transcribed both as і and as и
+    transcription = transliterate(inn)
+
+    lengths = sorted((len(transcription), len(name)))
+    if lengths[0] < MIN_LENGTH_RATIO * lengths[1]:
+        return 0
+
+    return max(
+        SequenceMatcher(None, transcription, name).ratio(),
+        SequenceMatcher(None, transcription.replace("і", "и"), name).ratio(),
+    )
+
+
+@lru_cache(maxsize=None)
+def load_inn_dictionary(path: str = MEDICINE_INFO_PATH) -> dict:
+    """
+    The load_inn_dictionary function builds a dictionary of Latin INNs and their Ukrainian names
+    from the medicine info file. Records whose active ingredient is a single Latin word are paired
+    with the first word of the medicine name, records like 'Німесулід (nimesulide)' with the name in front
+    of the parentheses. Pairs whose names are not transcriptions of the INN, e.g. brand names, are skipped:
+    the name must be about as long as the transcription and similar to it.
+    Names in the genitive case ('лопераміду') are reduced to the nominative if it appears in the file.
+    The dictionary is built once per path.
+
+    :param path: Specify the path to the json file with the medicine info
+    :return: A dictionary with lowercase Latin INNs as keys and lowercase Ukrainian names as values
+    """
+    with open(path, encoding='utf-8') as json_file:
+        medicines = json.load(json_file)
+
+    vocabulary = set()
+    for medicine in medicines:
+        for field in ("Назва", "Діюча речовина"):
+            vocabulary.update(re.findall(r"[а-щьюяєіїґ']+", medicine[field].lower()))
+
+    candidates = dict()
+
+    for medicine in medicines:
+        ingredient = medicine["Діюча речовина"].strip()
+        name_with_latin = _NAME_WITH_LATIN.match(ingredient)
+
+        if name_with_latin:
+            name, inn = name_with_latin.group(1).lower(), normalize_latin(name_with_latin.group(2))
+        else:
+            inn = normalize_latin(ingredient)
+            name = re.split(r"[\s\-]", medicine["Назва"].strip(), maxsplit=1)[0].lower()
+
+        if not _LATIN_WORD.match(inn) or not _CYRILLIC_WORD.match(name):
+            continue
+
+        if name[-1] in "ую" and name[:-1] in vocabulary:
+            name = name[:-1]
+
+        if _similarity(inn, name) >= MIN_SIMILARITY:
+            candidates.setdefault(inn, []).append(name)
+
+    return {inn: max(dict.fromkeys(names), key=names.count) for inn, names in candidates.items()}
+
+
+def translate(query_string: str, path: str = MEDICINE_INFO_PATH) -> str or None:
+    """
+    The translate function translates a query made of Latin INNs into Ukrainian without going to the network.
+
+    :param query_string: str: The query to translate
+    :param path: Specify the path to the json file with the medicine info
+    :return: The translated query, None if some of its words are not in the dictionary
+    """
+    dictionary = load_inn_dictionary(path)
+    words = [normalize_latin(word) for word in query_string.split()]
+
+    if not words or any(word not in dictionary for word in words):
+        return
+
+    return " ".join(dictionary[word] for word in words)
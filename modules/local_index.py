@@ -0,0 +1,174 @@
+import re
+import math
+import logging
+from functools import lru_cache
+
+from modules import inn_dictionary, ndjson
+
+logger = logging.getLogger(__name__)
+
+# The records of the medicine info file were collected from tabletki.ua by medicine_parser.parser
+LOCAL_SOURCE = "tabletki.ua"
+
+# Fields of the records that are searched and their weights
+INDEXED_FIELDS = {
+    "Назва": 2.0,
+    "Діюча речовина": 1.5,
+}
+
+# Case endings stripped from Ukrainian words, longest first, so 'лопераміду' and 'лоперамід' are the same token
+UKRAINIAN_ENDINGS = sorted([
+    "ами", "ями", "ові", "еві", "ого", "ому", "ими", "ій", "ів", "ої", "ою", "ею", "ом", "ем", "ах", "ях",
+    "ий", "их", "им", "у", "ю", "а", "я", "і", "и", "е", "о", "ь",
+], key=len, reverse=True)
+# Words shorter than this are left as they are
+MIN_STEM_LENGTH = 4
+
+_WORD = re.compile(r"[^\W_]+(?:['’ʼ][^\W_]+)*")
+_LATIN_WORD = re.compile(r"^[a-z]+$")
+
+
+def stem(word: str) -> str:
+    """
+    The stem function strips the case ending of a Ukrainian word.
+
+    :param word: str: Lowercase word
+    :return: The stem of the word
+    """
+    for ending in UKRAINIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+
+    return word
+
+
+def tokenize(text: str) -> list:
+    """
+    The tokenize function splits the text into search tokens. Words are lowercased and the apostrophes
+    are unified. Latin names of active ingredients, also the ones with Cyrillic homoglyphs,
+    are replaced with their Ukrainian names from the INN dictionary. Case endings are stripped.
+
+    :param text: str: The text to tokenize
+    :return: A list of tokens
+    """
+    tokens = list()
+    dictionary = inn_dictionary.load_inn_dictionary()
+
+    for word in _WORD.findall(text.lower()):
+        word = re.sub(r"[’ʼ]", "'", word)
+
+        latin = inn_dictionary.normalize_latin(word)
+        if _LATIN_WORD.match(latin):
+            word = dictionary.get(latin, latin)
+
+        tokens.append(stem(word))
+
+    return tokens
+
+
+class MedicineIndex:
+    """
+    The MedicineIndex class is an in-memory inverted index over medicine info records.
+    Records are ranked by the sum of the weights of the fields the query tokens are found in,
+    multiplied by the inverse document frequency of the tokens, so common words like 'натрію' count less.
+    A record is returned only if it contains every word of the query, doses aside.
+    """
+
+    def __init__(self, records):
+        self.records = list()
+        self._postings = dict()
+
+        seen = set()
+
+        for record in records:
+            if record["Назва"] in seen:
+                continue
+            seen.add(record["Назва"])
+
+            position = len(self.records)
+            self.records.append(record)
+
+            for field, weight in INDEXED_FIELDS.items():
+                for token in set(tokenize(record.get(field, ""))):
+                    postings = self._postings.setdefault(token, dict())
+                    postings[position] = postings.get(position, 0) + weight
+
+    def search(self, query: str, limit: int = 3) -> list:
+        """
+        The search function finds the records matching all the words of the query.
+        Words with digits are ignored, unless the query has nothing else.
+
+        :param query: str: The search query
+        :param limit: int: The maximal number of records returned
+        :return: A list of the best matching records, best first
+        """
+        tokens = set(tokenize(query))
+
+        # Doses like '500mg' rarely appear in the records the same way, the rest of the query decides
+        tokens = {token for token in tokens if not any(char.isdigit() for char in token)} or tokens
+        if not tokens:
+            return []
+
+        scores = None
+
+        for token in tokens:
+            postings = self._postings.get(token)
+            if not postings:
+                return []
+
+            idf = math.log(1 + len(self.records) / len(postings))
+            token_scores = {position: weight * idf for position, weight in postings.items()}
+
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {position: score + token_scores[position]
+                          for position, score in scores.items() if position in token_scores}
+
+        best = sorted(scores, key=lambda position: (-scores[position], position))[:limit]
+
+        return [self.records[position] for position in best]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+@lru_cache(maxsize=None)
+def load_index(path: str = inn_dictionary.MEDICINE_INFO_PATH) -> MedicineIndex:
+    """
+    The load_index function builds the index of the medicine info file, once per path.
+    The file can be a json list or the NDJSON output of medicine_parser.parser.
+
+    :param path: Specify the path to the medicine info file
+    :return: The MedicineIndex
+    """
+    index = MedicineIndex(ndjson.iter_records(path))
+    logger.info("Indexed %s medicines from %s", len(index), path)
+
+    return index
+
+
+def find_info(query_string: str, path: str = inn_dictionary.MEDICINE_INFO_PATH) -> tuple or None:
+    """
+    The find_info function looks the medicine up in the local index. The result has the same form
+    as the one of medicine_parser.find_info, so both can be shown the same way.
+
+    :param query_string: str: The name or the active ingredient of the medicine
+    :param path: Specify the path to the medicine info file
+    :return: A tuple of the source name and the medicine info, None if nothing was found
+    """
+    results = load_index(path).search(query_string, limit=1)
+
+    if not results:
+        return
+
+    record = results[0]
+
+    return LOCAL_SOURCE, {
+        "link": None,
+        "name": record["Назва"],
+        "active_ingredient": record["Діюча речовина"],
+        "pharmgroup": record["Фармгрупа"],
+        "indication": record["Показання"],
+        "contrandication": record["Протипоказання"],
+    }
@@ -1,13 +1,106 @@
+import os
 import json
 import re
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import bs4
 import regex
-import requests
-import cloudscraper
 
 from googletrans import Translator
 
+from dotenv import load_dotenv
+
+from modules import scraper_pool, html_extract, inn_dictionary, ndjson, database
+from modules.cache import PersistentCache, MongoCache, persistent_cached, normalize_query
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Seconds a single HTTP request to a medicine source may take
+REQUEST_TIMEOUT = float(os.environ.get('SOURCE_REQUEST_TIMEOUT', 10))
+# Seconds find_info waits for each of the sources, both make two requests
+TABLETKI_UA_TIMEOUT = float(os.environ.get('TABLETKI_UA_TIMEOUT', 15))
+DRUG_CONTROL_TIMEOUT = float(os.environ.get('DRUG_CONTROL_TIMEOUT', 15))
+# Seconds between two requests of the parser to the same website, a bulk run must not hammer tabletki.ua
+PARSER_MIN_INTERVAL = float(os.environ.get('PARSER_MIN_INTERVAL', 1.0))
+
+# Where the results of the scrapers are kept between restarts: "sqlite" for a local file, which is enough
+# for the offline parser, or "mongodb" for the bot database, as the disk of a Heroku dyno is wiped on restart
+SCRAPE_CACHE_BACKEND = os.environ.get('SCRAPE_CACHE_BACKEND', 'sqlite')
+# SQLite file of the "sqlite" backend, it must be on storage that survives restarts
+SCRAPE_CACHE_PATH = os.environ.get('SCRAPE_CACHE_PATH', 'scrape_cache.sqlite3')
+# Collection of the "mongodb" backend
+SCRAPE_CACHE_COLLECTION = "ScrapeCache"
+# Seconds a found medicine is fresh, a not found one is fresh, and either is served stale while being refreshed
+SCRAPE_CACHE_TTL = float(os.environ.get('SCRAPE_CACHE_TTL', 7 * 24 * 60 * 60))
+SCRAPE_NEGATIVE_TTL = float(os.environ.get('SCRAPE_NEGATIVE_TTL', 24 * 60 * 60))
+SCRAPE_STALE_TTL = float(os.environ.get('SCRAPE_STALE_TTL', 7 * 24 * 60 * 60))
+
+
+def _persistent_cache(table: str, ttl: float, negative_ttl: float = None, stale_ttl: float = 0) -> PersistentCache:
+    if SCRAPE_CACHE_BACKEND == 'mongodb':
+        return MongoCache(database.get_database()[SCRAPE_CACHE_COLLECTION], table,
+                          ttl=ttl, negative_ttl=negative_ttl, stale_ttl=stale_ttl)
+
+    if SCRAPE_CACHE_BACKEND != 'sqlite':
+        raise ValueError(f"Unknown SCRAPE_CACHE_BACKEND: {SCRAPE_CACHE_BACKEND}")
+
+    return PersistentCache(SCRAPE_CACHE_PATH, table, ttl=ttl, negative_ttl=negative_ttl, stale_ttl=stale_ttl)
+
+
+def _scrape_cache(table: str) -> PersistentCache:
+    return _persistent_cache(
+        table,
+        ttl=SCRAPE_CACHE_TTL,
+        negative_ttl=SCRAPE_NEGATIVE_TTL,
+        stale_ttl=SCRAPE_STALE_TTL,
+    )
+
+
+tabletki_ua_cache = _scrape_cache("tabletki_ua")
+drug_control_cache = _scrape_cache("likicontrol")
+
+# Translations of the queries are kept in the same store, they hardly ever change
+translation_cache = _persistent_cache(
+    "translations",
+    ttl=float(os.environ.get('TRANSLATION_CACHE_TTL', 90 * 24 * 60 * 60)),
+)
+
+_translator = None
+# googletrans keeps a single HTTP client per translator, which is not safe to share between threads
+_translator_lock = threading.Lock()
+
+# Threads the sources are queried in, shared by all the searches of the bot
+_lookup_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SOURCE_WORKERS', 8)),
+    thread_name_prefix="source-lookup",
+)
+
+
+def purge_caches(context=None) -> None:
+    """
+    The purge_caches function removes the entries of the scrape and translation caches that are too old
+    to be returned even as stale, so the SQLite file does not keep every query ever made.
+    It can be scheduled as a job of the Telegram job queue.
+
+    :param context: CallbackContext: Unused, passed by the job queue
+    :return: None
+    """
+    for cache in (tabletki_ua_cache, drug_control_cache, translation_cache):
+        try:
+            removed = cache.purge()
+        except Exception as e:
+            logger.warning("Purging %s failed: %s", cache.table, e)
+            continue
+
+        if removed:
+            logger.info("Purged %s expired entries from %s", removed, cache.table)
+
 
 def is_cyrillic(query_string: str) -> bool:
     """
@@ -20,17 +113,35 @@ def is_cyrillic(query_string: str) -> bool:
     return regex.search(r'\p{IsCyrillic}', query_string)
 
 
+@persistent_cached(translation_cache)
+def _translate_online(query_string: str) -> str:
+    global _translator
+
+    with _translator_lock:
+        if _translator is None:
+            _translator = Translator()
+
+        return _translator.translate(query_string, dest='uk').text
+
+
 def translate(query_string: str) -> str:
     """
     Takes a string as input and returns the translated string in ukrainian.
+    Names of active ingredients known from the medicine info file are translated offline,
+    other queries go to Google Translate and are cached in translation_cache.
 
     :param query_string: Pass the string to be translated as a parameter
     :return: A translation of the query string
     """
-    translator = Translator()
-    return translator.translate(query_string, dest='uk').text
+    translation = inn_dictionary.translate(query_string)
+
+    if translation is not None:
+        return translation
 
+    return _translate_online(query_string)
 
+
+@persistent_cached(tabletki_ua_cache)
 def find_info_tabletki_ua(query_string: str) -> dict or None:
     """
     Takes a string as an argument parses website and returns a dictionary with the following keys:
@@ -39,6 +150,8 @@ def find_info_tabletki_ua(query_string: str) -> dict or None:
         pharmgroup - pharmacological group of the medicine (e.g., analgesics, antiseptics)
         indication - medical indication
 
+    Results are cached in tabletki_ua_cache, find_info_tabletki_ua.__wrapped__ always queries the website.
+
     :param query_string: Pass the name of the medicine to find
     :return: A dictionary with the following keys: name, active_ingredient, pharmgroup, indication and contraindication
     """
@@ -92,10 +205,10 @@ def find_info_tabletki_ua(query_string: str) -> dict or None:
 
     url = 'https://tabletki.ua/uk/search/' + query_string
 
-    scraper = cloudscraper.create_scraper()
-    request_result = scraper.get(url)
+    scraper = scraper_pool.get_pool()
+    request_result = scraper.get(url, timeout=REQUEST_TIMEOUT)
 
-    search = bs4.BeautifulSoup(request_result.text, "html.parser")
+    search = html_extract.parse(request_result.text, "tabletki_search")
 
     availability_check = search.find("div", {"class": "page-not-found__message"})
 
@@ -113,12 +226,9 @@ def find_info_tabletki_ua(query_string: str) -> dict or None:
     medicine_name = search_result["title"]
     medicine_page_link = 'https://tabletki.ua' + search_result["href"]
 
-    medicine_photo_link = search_result.find("img")["src"]
-    medicine_photo = requests.get(medicine_photo_link).content
+    medicine_page = scraper.get(medicine_page_link, timeout=REQUEST_TIMEOUT)
 
-    medicine_page = scraper.get(medicine_page_link)
-
-    medicine = bs4.BeautifulSoup(medicine_page.text, "html.parser")
+    medicine = html_extract.parse(medicine_page.text, "tabletki_medicine")
 
     medicine_active_ingredient = parse_active_ingredient(medicine)
     medicine_pharmgroup = parse_pharmgroup(medicine)
@@ -136,6 +246,7 @@ def find_info_tabletki_ua(query_string: str) -> dict or None:
     return info
 
 
+@persistent_cached(drug_control_cache)
 def find_info_drug_control(query_string):
     """
     Takes a string as an argument parses website and returns a dictionary with the following keys:
@@ -144,6 +255,8 @@ def find_info_drug_control(query_string):
         pharmgroup - pharmacological group of the medicine (e.g., analgesics, antiseptics)
         indication - medical indication
 
+    Results are cached in drug_control_cache, find_info_drug_control.__wrapped__ always queries the website.
+
     :param query_string: Pass the name of the medicine to find
     :return: A dictionary with the following keys: name, active_ingredient, pharmgroup, indication and contraindication
     """
@@ -218,10 +331,10 @@ def find_info_drug_control(query_string):
 
     url = 'https://likicontrol.com.ua/пошук-ліків/?' + query_string
 
-    scraper = cloudscraper.create_scraper()
-    request_result = scraper.get(url)
+    scraper = scraper_pool.get_pool()
+    request_result = scraper.get(url, timeout=REQUEST_TIMEOUT)
 
-    search = bs4.BeautifulSoup(request_result.text, "html.parser")
+    search = html_extract.parse(request_result.text, "likicontrol_search")
 
     try:
         medicine_page_link = search.find("a", string='Інструкція')["href"]
@@ -230,8 +343,8 @@ def find_info_drug_control(query_string):
     else:
         medicine_page_link = "https://likicontrol.com.ua" + medicine_page_link
 
-    medicine_page = scraper.get(medicine_page_link)
-    medicine = bs4.BeautifulSoup(medicine_page.text, "html.parser")
+    medicine_page = scraper.get(medicine_page_link, timeout=REQUEST_TIMEOUT)
+    medicine = html_extract.parse(medicine_page.text, "likicontrol_medicine")
 
     medicine_name = medicine.find("h1").text
 
@@ -251,6 +364,62 @@ def find_info_drug_control(query_string):
     return info
 
 
+# Sources find_info queries: name shown to the user -> (search function, seconds to wait for it)
+SOURCES = {
+    "tabletki.ua": (find_info_tabletki_ua, TABLETKI_UA_TIMEOUT),
+    "likicontrol.com.ua": (find_info_drug_control, DRUG_CONTROL_TIMEOUT),
+}
+
+
+def find_info(query_string: str) -> tuple or None:
+    """
+    The find_info function queries all the SOURCES at the same time and returns the first answer found.
+    Every source has its own deadline: a slow source is given up on when its deadline passes,
+    without delaying the answer of the others. Sources that fail are skipped. The lookups that are still queued
+    when an answer is found are cancelled, the running ones are bounded by REQUEST_TIMEOUT.
+
+    :param query_string: Pass the name of the medicine to find
+    :return: A tuple of the source name and the dictionary returned by its search function,
+             None if no source found the medicine
+    """
+    started = time.perf_counter()
+    pending = {
+        _lookup_executor.submit(search, query_string): (source, started + deadline)
+        for source, (search, deadline) in SOURCES.items()
+    }
+
+    try:
+        while pending:
+            next_deadline = min(deadline for _, deadline in pending.values())
+            finished, _ = wait(pending, timeout=max(next_deadline - time.perf_counter(), 0),
+                               return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                source, _ = pending.pop(future)
+
+                try:
+                    info = future.result()
+                except Exception as e:
+                    logger.warning("Search on %s failed: %s", source, e)
+                    continue
+
+                if info:
+                    logger.info("Found %s on %s in %.2f s", query_string, source, time.perf_counter() - started)
+                    return source, info
+
+            now = time.perf_counter()
+            for future, (source, deadline) in list(pending.items()):
+                if deadline <= now:
+                    logger.warning("%s did not answer in %.0f s", source, deadline - started)
+                    future.cancel()
+                    del pending[future]
+    finally:
+        for future in pending:
+            future.cancel()
+
+    return
+
+
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', print_end="") -> None:
     """
     The print_progress_bar function prints a progress bar to the console.
@@ -281,39 +450,266 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def parser():
+def _to_medicine_info(data: dict) -> dict:
+    return {
+        "Назва": data["name"],
+        "Діюча речовина": data["active_ingredient"],
+        "Фармгрупа": data["pharmgroup"],
+        "Показання": data["indication"],
+        "Протипоказання": data["contrandication"]
+    }
+
+
+def record_hash(record: dict or None) -> str or None:
+    """
+    The record_hash function computes a hash of the content of a medicine info record,
+    used to tell whether a refreshed record has changed.
+
+    :param record: dict: The medicine info record
+    :return: The SHA-256 hex digest of the record, None if there is no record
+    """
+    if record is None:
+        return
+
+    return hashlib.sha256(json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _scrape_name(name: str, fresh: bool = False) -> dict:
     """
-    Returns a dictionary with the name, active ingredient,
-    pharmaceutical group and other information about the medicine. The function uses find_info_tabletki_ua() to get
-    the data from tabletki.ua
+    The _scrape_name function looks the name up on tabletki.ua and turns the result into a journal entry.
 
-    :return: A list of dictionaries with the information about medicines
+    :param name: str: The name of the medicine
+    :param fresh: bool: Skip tabletki_ua_cache and store the new result in it
+    :return: A dictionary with the name, the status of the lookup ("found", "not_found" or "failed"),
+             the medicine info record if it was found, the time of the lookup and the hash of the record
     """
-    with open('names.txt') as file:
-        names_lines = file.readlines()
+    fetched_at = time.time()
+
+    try:
+        if fresh:
+            data = find_info_tabletki_ua.__wrapped__(name)
+            tabletki_ua_cache.set(normalize_query(name), data)
+        else:
+            data = find_info_tabletki_ua(name)
+    except Exception as e:
+        logger.warning("Failed to scrape %s: %s", name, e)
+        return {"name": name, "status": "failed", "record": None, "fetched_at": fetched_at, "hash": None}
+
+    if data and data["active_ingredient"]:
+        record = _to_medicine_info(data)
+        return {"name": name, "status": "found", "record": record, "fetched_at": fetched_at,
+                "hash": record_hash(record)}
+
+    return {"name": name, "status": "not_found", "record": None, "fetched_at": fetched_at, "hash": None}
+
+
+def read_journal(journal_path: str, with_records: bool = True) -> dict:
+    """
+    The read_journal function reads the entries written by parser to its journal.
+    A line cut off by a crash is ignored, as it is the only one that can be incomplete.
+
+    :param journal_path: str: Path to the journal file
+    :param with_records: bool: Keep the medicine info records, False to keep only the statuses of the lookups
+    :return: A dictionary with the names as keys and their latest entries as values
+    """
+    entries = dict()
+
+    if not os.path.exists(journal_path):
+        return entries
+
+    for entry in ndjson.iter_ndjson(journal_path):
+        if not with_records:
+            entry.pop("record", None)
+
+        entries[entry["name"]] = entry
+
+    return entries
+
+
+def compact_journal(journal_path: str) -> int:
+    """
+    The compact_journal function rewrites the journal keeping only the latest entry of each name,
+    so it does not keep growing with every refresh. The lines are copied as they are, without loading
+    the whole journal, and the old journal is replaced only when the new one is complete.
+
+    :param journal_path: str: Path to the journal file
+    :return: The number of entries left in the journal
+    """
+    latest_lines = dict()
+
+    with open(journal_path, encoding='utf-8') as journal:
+        for number, line in enumerate(journal):
+            try:
+                latest_lines[json.loads(line)["name"]] = number
+            except json.JSONDecodeError:
+                continue
+
+    kept_lines = set(latest_lines.values())
+    compacted_path = journal_path + ".compacted"
+
+    with open(journal_path, encoding='utf-8') as journal, open(compacted_path, "w", encoding='utf-8') as compacted:
+        for number, line in enumerate(journal):
+            if number in kept_lines:
+                compacted.write(line)
+
+    os.replace(compacted_path, journal_path)
+
+    return len(kept_lines)
+
+
+def parser(names_path: str = 'names.txt', output_path: str = 'medicine_info.json',
+           journal_path: str = 'medicine_info.journal.jsonl', workers: int = 4,
+           min_interval: float = PARSER_MIN_INTERVAL, refresh_after: float = None) -> None:
+    """
+    Collects the name, active ingredient, pharmaceutical group and other information about the medicines
+    from names_path. The function uses find_info_tabletki_ua() to get the data from tabletki.ua.
+
+    The names are looked up in several threads at once. Every lookup is appended to the journal as soon as
+    it is done, so an interrupted run can be started again and continues where it stopped, retrying only
+    the names that failed. The requests to tabletki.ua are spaced min_interval seconds apart for the duration
+    of the run, the previous interval of the shared scraper pool is restored afterwards.
+
+    If refresh_after is given, the names looked up more than refresh_after seconds ago are fetched again,
+    bypassing tabletki_ua_cache, and the changed records replace the old ones. A record that fails to refresh
+    is kept as it was. The journal is compacted at the end of such a run.
+
+    If output_path ends with .ndjson or .jsonl, the records are streamed to it one per line as they are found,
+    so it can be consumed while the parser runs. Otherwise a json list is written when all the names are done.
+
+    :param names_path: str: Path to the file with a name of a medicine on each line
+    :param output_path: str: Path to the file the records are written to
+    :param journal_path: str: Path to the journal of the lookups
+    :param workers: int: Number of names looked up at the same time
+    :param min_interval: float: Seconds between two requests to the same website, PARSER_MIN_INTERVAL by default
+    :param refresh_after: float: Seconds after which a lookup is stale, None to never refresh
+    :return: None
+    """
+    pool = scraper_pool.get_pool()
+    previous_interval, pool.min_interval = pool.min_interval, min_interval
+
+    try:
+        _parse(names_path, output_path, journal_path, workers, refresh_after)
+    finally:
+        pool.min_interval = previous_interval
+
+
+def _parse(names_path: str, output_path: str, journal_path: str, workers: int, refresh_after: float or None) -> None:
+    """
+    The _parse function runs the parser, see the parser function for the description of the arguments.
+
+    :return: None
+    """
+    with open(names_path, encoding='utf-8') as file:
+        names = list(dict.fromkeys(line.strip() for line in file if line.strip()))
+
+    entries = read_journal(journal_path, with_records=False)
+
+    def is_done(name: str) -> bool:
+        entry = entries.get(name)
+
+        if entry is None or entry["status"] == "failed":
+            return False
+        if refresh_after is None:
+            return True
+
+        # Entries journaled before refreshes were introduced have no fetch time and are stale
+        return time.time() - entry.get("fetched_at", 0) < refresh_after
+
+    def is_latest(entry: dict) -> bool:
+        # The journal can hold older entries of a name until it is compacted
+        return entries[entry["name"]].get("fetched_at") == entry.get("fetched_at")
+
+    pending = [name for name in names if not is_done(name)]
+    stale = {name for name in pending if entries.get(name, {}).get("status") in ("found", "not_found")}
+
+    if len(pending) < len(names):
+        print(f"Resuming: {len(names) - len(pending)} of {len(names)} names are already done")
+    if stale:
+        print(f"Refreshing {len(stale)} stale names")
+
+    streaming = os.path.splitext(output_path)[1] in ndjson.NDJSON_EXTENSIONS
+    output = None
+
+    if streaming:
+        # Records of the previous runs are written again, so the output is complete even if it was removed.
+        # Stale ones are written when they are refreshed, or at the end if the refresh fails.
+        output = ndjson.NDJSONWriter(output_path)
+
+        if entries:
+            for entry in ndjson.iter_ndjson(journal_path):
+                if entry["status"] == "found" and entry["name"] not in stale and is_latest(entry):
+                    output.write(entry["record"])
+
+    if pending:
+        print_progress_bar(0, len(pending), prefix='Progress:', suffix='Complete', length=50)
+
+    changed = 0
+    refresh_failed = set()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parser") as executor, \
+            ndjson.NDJSONWriter(journal_path, append=True) as journal:
+        names_left = iter(pending)
+        in_flight = set()
+        done = 0
+
+        while True:
+            # Keep a bounded number of lookups queued, so a long list of names does not pile up in memory
+            for name in names_left:
+                in_flight.add(executor.submit(_scrape_name, name, name in stale))
+                if len(in_flight) >= workers * 2:
+                    break
+
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                entry = future.result()
+                name = entry["name"]
+
+                done += 1
+                print_progress_bar(done, len(pending), prefix='Progress:', suffix='Complete', length=50)
+
+                if name in stale and entry["status"] == "failed":
+                    refresh_failed.add(name)
+                    continue
+
+                if name in stale and entry["hash"] != entries[name].get("hash"):
+                    changed += 1
+
+                journal.write(entry)
+                if output is not None and entry["status"] == "found":
+                    output.write(entry["record"])
+
+                entry.pop("record")
+                entries[name] = entry
+
+    if output is not None:
+        if refresh_failed:
+            for entry in ndjson.iter_ndjson(journal_path):
+                if entry["name"] in refresh_failed and entry["status"] == "found" and is_latest(entry):
+                    output.write(entry["record"])
 
-    info_list = list()
+        output.close()
 
-    print_progress_bar(0, len(names_lines), prefix='Progress:', suffix='Complete', length=50)
+    if stale:
+        compact_journal(journal_path)
 
-    found = 0
-    for i, name in enumerate(names_lines):
-        data = find_info_tabletki_ua(name)
+    if output is None:
+        records = {
+            entry["name"]: entry["record"]
+            for entry in ndjson.iter_ndjson(journal_path) if entry["status"] == "found" and is_latest(entry)
+        }
 
-        if data and data["active_ingredient"]:
-            medicine_info = {
-                "Назва": data["name"],
-                "Діюча речовина": data["active_ingredient"],
-                "Фармгрупа": data["pharmgroup"],
-                "Показання": data["indication"],
-                "Протипоказання": data["contrandication"]
-            }
-            found += 1
-            info_list.append(medicine_info)
+        with open(output_path, "w", encoding='utf-8') as final:
+            json.dump([records[name] for name in names if name in records], final,
+                      sort_keys=False, ensure_ascii=False, indent=4)
 
-        print_progress_bar(i + 1, len(names_lines), prefix='Progress:', suffix='Complete', length=50)
+    found = sum(entries.get(name, {}).get("status") == "found" for name in names)
+    failed = sum(entries.get(name, {}).get("status") == "failed" for name in names)
 
-    with open("medicine_info.json", "w", encoding='utf-8') as final:
-        json.dump(info_list, final, sort_keys=False, ensure_ascii=False, indent=4)
+    if stale:
+        print(f"Refreshed {len(stale) - len(refresh_failed)} of {len(stale)} stale names, {changed} changed")
 
-    print(f"Done. Found {found} out of {len(names_lines)} medicines")
+    print(f"Done. Found {found} out of {len(names)} medicines, {failed} failed and can be retried")
@@ -0,0 +1,128 @@
+import os
+import json
+import logging
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# Extensions of the files read and written line by line
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+# Bytes read at once when looking for the end of the last complete line
+CHUNK_SIZE = 64 * 1024
+
+
+def truncate_partial_line(path: str) -> int:
+    """
+    The truncate_partial_line function removes the last line of the file if it does not end with a newline
+    and is not a complete record, which is what is left of a line whose writing was interrupted.
+    A complete record that only lacks the newline is kept and the newline is added.
+
+    :param path: str: Path to the file, nothing is done if it does not exist
+    :return: The number of removed bytes
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, "rb+") as file:
+        size = file.seek(0, os.SEEK_END)
+        end = size
+
+        # Read backwards until the last newline, the broken line is usually short
+        while end > 0:
+            start = max(end - CHUNK_SIZE, 0)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b"\n")
+
+            if newline != -1:
+                end = start + newline + 1
+                break
+
+            end = start
+
+        if end == size:
+            return 0
+
+        file.seek(end)
+        try:
+            json.loads(file.read())
+        except ValueError:
+            file.truncate(end)
+            logger.warning("Removed a broken line of %s bytes at the end of %s", size - end, path)
+            return size - end
+
+        # Only the newline is missing, the record is complete
+        file.write(b"\n")
+
+    return 0
+
+
+class NDJSONWriter:
+    """
+    The NDJSONWriter class writes records to a newline-delimited JSON file, one record per line.
+    Every line is flushed as soon as it is written, so readers can consume the file while it grows
+    and a crash loses at most the line being written. When appending, a line cut off by such a crash
+    is removed first, otherwise the next record would be glued to it and lost with it.
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+
+        if append:
+            truncate_partial_line(path)
+
+        self._file = open(path, "a" if append else "w", encoding='utf-8')
+
+    def write(self, record) -> None:
+        """
+        The write function appends the record to the file.
+
+        :param record: A JSON serializable record
+        :return: None
+        """
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_ndjson(path: str) -> Iterator:
+    """
+    The iter_ndjson function reads the records of a newline-delimited JSON file one by one.
+    Empty lines are skipped, as well as broken ones, e.g. the last line of a file cut off by a crash.
+
+    :param path: str: Path to the file
+    :return: An iterator over the records
+    """
+    with open(path, encoding='utf-8') as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping broken line %s of %s", number, path)
+
+
+def iter_records(path: str) -> Iterator:
+    """
+    The iter_records function reads medicine info records from either a newline-delimited JSON file,
+    which is streamed, or a file with a JSON array, like resources/medicine_info.json, which is loaded whole.
+    The format is chosen by the extension of the file.
+
+    :param path: str: Path to the file
+    :return: An iterator over the records
+    """
+    if os.path.splitext(path)[1] in NDJSON_EXTENSIONS:
+        yield from iter_ndjson(path)
+        return
+
+    with open(path, encoding='utf-8') as file:
+        yield from json.load(file)
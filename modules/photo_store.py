@@ -0,0 +1,100 @@
+import logging
+
+import gridfs
+from bson import ObjectId
+from pymongo.database import Database
+from pymongo.collection import Collection
+
+from modules.database import get_database
+
+logger = logging.getLogger(__name__)
+
+# Name of the GridFS bucket the medicine photos are stored in
+PHOTOS_BUCKET = "Photos"
+
+
+def _get_fs(database: Database) -> gridfs.GridFS:
+    return gridfs.GridFS(database, collection=PHOTOS_BUCKET)
+
+
+def store_photo(database: Database, photo: bytes) -> ObjectId or None:
+    """
+    The store_photo function saves the photo to GridFS.
+
+    :param database: Database: The database with the photos bucket
+    :param photo: bytes: Binary data of the photo
+    :return: The ID of the stored photo, None if the photo is empty
+    """
+    if not photo:
+        return
+
+    return _get_fs(database).put(photo)
+
+
+def load_photo(database: Database, document: dict) -> bytes or None:
+    """
+    The load_photo function loads the photo of a medicine document. Documents reference their photo by photo_id,
+    documents that have not been migrated yet keep the binary data in the photo field.
+
+    :param database: Database: The database with the photos bucket
+    :param document: dict: The medicine document
+    :return: The binary data of the photo, None if the document has no photo
+    """
+    photo_id = document.get("photo_id")
+
+    if photo_id is not None:
+        try:
+            return _get_fs(database).get(photo_id).read()
+        except gridfs.NoFile:
+            logger.warning("Photo %s is missing from the photos bucket", photo_id)
+            return
+
+    return document.get("photo") or None
+
+
+def delete_photo(database: Database, document: dict) -> None:
+    """
+    The delete_photo function removes the photo referenced by a medicine document from GridFS.
+
+    :param database: Database: The database with the photos bucket
+    :param document: dict: The medicine document
+    :return: None
+    """
+    photo_id = document.get("photo_id")
+
+    if photo_id is not None:
+        _get_fs(database).delete(photo_id)
+
+
+def migrate_photos(database: Database, collection: Collection) -> int:
+    """
+    The migrate_photos function moves the photos stored inline in the medicine documents to GridFS.
+    Each document gets a photo_id reference and loses its photo field. Empty photos are simply removed.
+    The migration can be interrupted and run again, already migrated documents are skipped.
+
+    :param database: Database: The database with the photos bucket
+    :param collection: Collection: The medicine collection
+    :return: The number of migrated documents
+    """
+    migrated = 0
+
+    for document in collection.find({"photo": {"$exists": True}}, {"photo": 1}):
+        update = {"$unset": {"photo": ""}}
+
+        photo_id = store_photo(database, document["photo"])
+        if photo_id is not None:
+            update["$set"] = {"photo_id": photo_id}
+
+        collection.update_one({"_id": document["_id"]}, update)
+        migrated += 1
+
+        logger.info("Migrated photo of %s", document["_id"])
+
+    return migrated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    db = get_database()
+
+    print(f"Done. Migrated {migrate_photos(db, db.TestBotCollection)} documents")
@@ -0,0 +1,91 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+
+class BoundedProcessPool:
+    """
+    The BoundedProcessPool class wraps a ProcessPoolExecutor and limits the number of tasks that can be in flight
+    at the same time. When the limit is reached, submit blocks the calling thread until a slot is freed, so a burst
+    of work applies backpressure to the handlers producing it instead of piling up in memory.
+
+    The underlying executor is created lazily on the first submit, using the "spawn" start method, so the worker
+    processes do not inherit the sockets and threads of the MongoDB client or the Telegram updater.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def submit(self, fn: Callable, *args, timeout: Optional[float] = None) -> Future:
+        """
+        The submit function schedules fn(*args) in one of the worker processes and returns a Future for its result.
+        If the pool already has max_pending tasks in flight, it waits for a free slot first.
+
+        :param fn: A picklable module-level function to run in a worker process
+        :param args: Arguments passed to the function
+        :param timeout: Seconds to wait for a free slot, None to wait indefinitely
+        :return: A Future holding the result of the call
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("Process pool is saturated")
+
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._reset_executor(executor)
+                future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn: Callable, *args, timeout: Optional[float] = None):
+        """
+        The run function submits fn(*args) to the pool and waits for its result.
+
+        :param fn: A picklable module-level function to run in a worker process
+        :param args: Arguments passed to the function
+        :param timeout: Seconds to wait for a free slot and, separately, for the result
+        :return: The value returned by the function
+        """
+        return self.submit(fn, *args, timeout=timeout).result(timeout=timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        The shutdown function stops the worker processes. The pool can still be used afterwards,
+        a new executor will be started on the next submit.
+
+        :param wait: Wait for the pending tasks to finish
+        :return: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,173 @@
+import os
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+import cloudscraper
+from requests.cookies import RequestsCookieJar
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ScraperPool:
+    """
+    The ScraperPool class keeps a set of cloudscraper sessions alive between requests, so the TLS connections
+    are reused and the Cloudflare challenge is not solved again for every search. All the sessions share
+    one cookie jar, so the clearance cookies obtained by one of them are used by the others.
+
+    A session is used by one thread at a time. At most max_sessions sessions are created, further callers wait
+    for one to be returned. Requests to a single host are limited to max_per_host at the same time
+    and, if min_interval is set, are started at least min_interval seconds apart.
+    """
+
+    def __init__(self, max_sessions: int, max_per_host: int, min_interval: float = 0):
+        self.max_sessions = max_sessions
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+
+        self.cookies = RequestsCookieJar()
+
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._host_slots = dict()
+        self._next_request = dict()
+
+    def _new_session(self) -> cloudscraper.CloudScraper:
+        scraper = cloudscraper.create_scraper()
+        scraper.cookies = self.cookies
+
+        logger.info("Created scraper session %s of %s", self._created, self.max_sessions)
+        return scraper
+
+    @contextmanager
+    def session(self):
+        """
+        The session function checks out a session from the pool for the duration of the with block.
+        The most recently used session is preferred, as its connections are the most likely to be still open.
+
+        :return: A context manager yielding a cloudscraper session
+        """
+        try:
+            scraper = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.max_sessions
+                if create:
+                    self._created += 1
+
+            if create:
+                try:
+                    scraper = self._new_session()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                scraper = self._idle.get()
+
+        try:
+            yield scraper
+        finally:
+            self._idle.put(scraper)
+
+    def _host_slots_for(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _wait_turn(self, url: str) -> None:
+        if self.min_interval <= 0:
+            return
+
+        host = urlsplit(url).netloc
+
+        with self._lock:
+            now = time.monotonic()
+            turn = max(now, self._next_request.get(host, 0))
+            self._next_request[host] = turn + self.min_interval
+
+        if turn > now:
+            time.sleep(turn - now)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        The get function sends a GET request with one of the pooled sessions.
+
+        :param url: str: The URL to request
+        :param kwargs: Keyword arguments passed to the session, e.g. timeout
+        :return: The response
+        """
+        self._wait_turn(url)
+
+        with self._host_slots_for(url):
+            with self.session() as scraper:
+                return scraper.get(url, **kwargs)
+
+    def close(self) -> None:
+        """
+        The close function closes the idle sessions and their connections.
+        Sessions that are in use are not closed: they are returned to the pool when their requests are done
+        and reused by the following ones, so close is meant to be called when no more requests are made.
+
+        :return: None
+        """
+        while True:
+            try:
+                scraper = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            scraper.close()
+
+            with self._lock:
+                self._created -= 1
+
+
+def get_pool() -> ScraperPool:
+    """
+    The get_pool function returns the scraper pool shared by all the searches of a process.
+    The pool is configured with the SCRAPER_SESSIONS, SCRAPER_MAX_PER_HOST and SCRAPER_MIN_INTERVAL
+    environment variables and is created on the first call.
+
+    :return: The shared ScraperPool
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            sessions = int(os.environ.get('SCRAPER_SESSIONS', 4))
+            max_per_host = int(os.environ.get('SCRAPER_MAX_PER_HOST', sessions))
+            min_interval = float(os.environ.get('SCRAPER_MIN_INTERVAL', 0))
+
+            logger.info("Starting scraper pool: %s sessions, %s requests per host max", sessions, max_per_host)
+            _pool = ScraperPool(max_sessions=sessions, max_per_host=max_per_host, min_interval=min_interval)
+
+        return _pool
+
+
+def shutdown() -> None:
+    """
+    The shutdown function closes the sessions of the shared pool.
+
+    :return: None
+    """
+    with _pool_lock:
+        pool = _pool
+
+    if pool is not None:
+        pool.close()
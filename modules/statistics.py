@@ -1,53 +1,191 @@
-import os
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo.errors import PyMongoError
 
-from dotenv import load_dotenv
-import json
+from modules import country_codes, database
+from modules.cache import LRUCache
 
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import seaborn as sns
+logger = logging.getLogger(__name__)
 
-from regex_engine import generator
+# _id of the document that marks the counters collection as seeded
+COUNTERS_BUILT_MARKER = "_built"
 
-load_dotenv()
+# pandas, matplotlib and seaborn are imported on first use: loading them takes seconds
+# and only the /countries command needs them
 
-cluster = MongoClient(os.environ.get('cluster'))
-db = cluster.TestBotDatabase
-collection = db.TestBotCollection
+
+def get_collection():
+    """
+    The get_collection function returns the medicine collection.
+
+    :return: The medicine collection
+    """
+    return database.get_database().TestBotCollection
+
+
+def get_counters():
+    """
+    The get_counters function returns the collection with the number of medicines per country,
+    maintained on every insert: {"_id": country, "quantity": int}. Once the counters are seeded,
+    the collection also holds the COUNTERS_BUILT_MARKER document.
+
+    :return: The counters collection
+    """
+    return database.get_database().CountryCounters
+
+
+def _import_pyplot():
+    import matplotlib
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot as plt
+    return plt
+
+
+# pyplot keeps global state, so all charts are rendered one at a time in this thread
+chart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart")
+# Rendered PNG charts by the snapshot of the plotted quantities
+chart_cache = LRUCache(max_size=16)
+
+
+def count_quantities(path: str) -> dict:
+    """
+    The count_quantities function counts the barcodes registered in each country directly from the medicine collection.
+    The collection is read with a single aggregation that counts the documents per 3-digit barcode prefix,
+    the prefixes are then assigned to countries with the prefix index from modules.country_codes.
+
+    :param path: Specify the path to the json file containing the country codes
+    :return: A dictionary with the countries as keys and the number of documents with their prefixes as values
+    """
+    quantities = {country: 0 for country in country_codes.get_countries(path)}
+
+    prefix_counts = get_collection().aggregate([
+        {"$group": {"_id": {"$substrCP": ["$code", 0, 3]}, "quantity": {"$sum": 1}}}
+    ])
+
+    for prefix_count in prefix_counts:
+        prefix = prefix_count["_id"]
+        if not prefix or not prefix.isdigit():
+            continue
+
+        country = country_codes.get_country_by_prefix(int(prefix), path)
+        if country is not None:
+            quantities[country] += prefix_count["quantity"]
+
+    return quantities
+
+
+def rebuild_counters(path: str) -> dict:
+    """
+    The rebuild_counters function recounts the medicines per country and replaces the counters collection.
+    It is used to reconcile the counters with the medicine collection and to seed them for the first time.
+    The counters are written to a temporary collection, which is then renamed over the counters,
+    so readers never see a half-written set.
+
+    Medicines inserted while the recount runs may be missed: their increments go to the old collection,
+    which is dropped by the rename. Running the rebuild again reconciles them.
+
+    :param path: Specify the path to the json file containing the country codes
+    :return: A dictionary with the countries as keys and the number of their medicines as values
+    """
+    quantities = count_quantities(path)
+
+    counters = get_counters()
+    rebuilt = counters.database[f"{counters.name}_rebuild_{ObjectId()}"]
+
+    rebuilt.insert_many(
+        [{"_id": country, "quantity": quantity} for country, quantity in quantities.items()]
+        + [{"_id": COUNTERS_BUILT_MARKER}]
+    )
+    rebuilt.rename(counters.name, dropTarget=True)
+
+    return quantities
+
+
+def ensure_counters(path: str) -> None:
+    """
+    The ensure_counters function seeds the counters collection if it has not been seeded yet.
+    It is called at bot startup, before any medicine can be added. Errors are logged, not raised,
+    the counters are then seeded by the first /countries command.
+
+    :param path: Specify the path to the json file containing the country codes
+    :return: None
+    """
+    try:
+        if get_counters().find_one({"_id": COUNTERS_BUILT_MARKER}) is None:
+            rebuild_counters(path)
+            logger.info("Seeded the country counters")
+    except PyMongoError as e:
+        logger.error("Failed to seed the country counters: %s", e)
+
+
+def update_counter(barcode: str, amount: int) -> None:
+    """
+    The update_counter function adds amount to the counter of the country the barcode belongs to.
+    Barcodes with unknown prefixes are not counted. Seeding creates a counter for every country,
+    so nothing is upserted: before the counters are seeded, the change is left to the seeding recount.
+    The update is best-effort: the medicine is already saved, so errors are logged, not raised,
+    and the counters can be reconciled with /rebuild_countries.
+
+    :param barcode: str: Barcode of the added or removed medicine
+    :param amount: int: 1 for an added medicine, -1 for a removed one
+    :return: None
+    """
+    country = country_codes.get_country(barcode)
+
+    if country is None:
+        return
+
+    try:
+        get_counters().update_one({"_id": country}, {"$inc": {"quantity": amount}})
+    except PyMongoError as e:
+        logger.error("Failed to update the counter of %s by %s: %s", country, amount, e)
+
+
+def record_added(barcode: str) -> None:
+    """
+    The record_added function counts a medicine inserted into the collection.
+
+    :param barcode: str: Barcode of the added medicine
+    :return: None
+    """
+    update_counter(barcode, 1)
+
+
+def record_removed(barcode: str) -> None:
+    """
+    The record_removed function uncounts a medicine deleted from the collection.
+
+    :param barcode: str: Barcode of the removed medicine
+    :return: None
+    """
+    update_counter(barcode, -1)
 
 
 def get_quantities(path: str) -> dict:
     """
     The get_quantities function takes a path to a json file containing country codes and returns
-    a dictionary with the quantities of countries that match the regex for each code.
+    a dictionary with the number of barcodes registered in each country.
+    The numbers are read from the counters collection, which is rebuilt if it has not been seeded yet.
 
     :param path: Specify the path to the json file containing the country codes
-    :return: A dictionary with the country codes as keys and the number of documents that match each code as values
+    :return: A dictionary with the countries as keys and the number of their medicines as values
     """
-    with open(path) as json_file:
-        country_codes = json.load(json_file)
-    
-    quantities = dict()
-    generate = generator()
-    
-    for key, value in country_codes.items():
-        key_splitted = key.split("–")
-    
-        if len(key_splitted) == 2:
-            key_pair = (int(key_splitted[0]), int(key_splitted[1]))
-            regex = generate.numerical_range(key_pair[0], key_pair[1]).strip("$")
-            quantity = collection.count_documents({"code": {'$regex': f'{regex}'}})
-        else:
-            int_key = int(key)
-            quantity = collection.count_documents({"code": {'$regex': f'^{int_key}'}})
-    
-        quantities[value] = int(quantity)
+    quantities = {country: 0 for country in country_codes.get_countries(path)}
+
+    documents = list(get_counters().find())
+    if not any(document["_id"] == COUNTERS_BUILT_MARKER for document in documents):
+        return rebuild_counters(path)
+
+    for document in documents:
+        if document["_id"] in quantities:
+            quantities[document["_id"]] = document["quantity"]
 
     return quantities
-    
+
 
 def get_not_empty_countries(quantities: dict) -> dict:
     """
@@ -68,7 +206,7 @@ def get_not_empty_countries(quantities: dict) -> dict:
     return countries
 
 
-def get_bar_chart(countries: dict) -> plt.figure:
+def get_bar_chart(countries: dict) -> "matplotlib.figure.Figure":
     """
     The get_bar_chart function creates a bar chart of the countries and their respective quantities.
     It takes in a dictionary as an argument, which is then converted into a pandas dataframe. The dataframe
@@ -77,6 +215,12 @@ def get_bar_chart(countries: dict) -> plt.figure:
     :param countries: Pass a dictionary of countries and their respective number of msb's
     :return: A matplotlib.pyplot.figure bar chart of the countries and their respective quantity
     """
+    import pandas as pd
+    import seaborn as sns
+    from matplotlib.ticker import MaxNLocator
+
+    plt = _import_pyplot()
+
     df = pd.DataFrame(countries.items(), columns=['Country', 'Quantity'])
     df.sort_values(by='Quantity', ignore_index=True, ascending=False, inplace=True)
 
@@ -102,3 +246,40 @@ def get_bar_chart(countries: dict) -> plt.figure:
                         label_type='center', color='white')
 
     return plot
+
+
+def _render_bar_chart(key: tuple, countries: dict) -> bytes:
+    png = chart_cache.get(key)
+    if png is not None:
+        return png
+
+    plt = _import_pyplot()
+    plot = get_bar_chart(countries)
+
+    try:
+        img_buf = io.BytesIO()
+        plot.savefig(img_buf, format='png')
+        png = img_buf.getvalue()
+    finally:
+        plt.close(plot)
+
+    chart_cache.set(key, png)
+    return png
+
+
+def get_bar_chart_png(countries: dict) -> bytes:
+    """
+    The get_bar_chart_png function returns the bar chart of the countries rendered as a PNG image.
+    Charts are rendered in the chart thread with the headless Agg backend, the figures are closed right after
+    rendering. The images are cached by the plotted quantities, so an unchanged chart is not rendered again.
+
+    :param countries: Pass a dictionary of countries and their respective number of medicines
+    :return: The binary data of the PNG image
+    """
+    key = tuple(sorted(countries.items()))
+
+    png = chart_cache.get(key)
+    if png is not None:
+        return png
+
+    return chart_executor.submit(_render_bar_chart, key, countries).result()
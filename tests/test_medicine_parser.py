@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+for dependency in ("bs4", "bson", "regex", "googletrans", "cloudscraper", "dotenv"):
+    pytest.importorskip(dependency)
+
+from modules import medicine_parser  # noqa: E402
+
+
+def journal_entry(name: str, status: str = "found") -> dict:
+    record = {"Назва": f"{name}1"} if status == "found" else None
+
+    return {"name": name, "status": status, "record": record, "fetched_at": 0,
+            "hash": medicine_parser.record_hash(record) if record else None}
+
+
+@pytest.fixture
+def scraped(monkeypatch):
+    names = list()
+
+    def scrape_name(name, fresh=False):
+        names.append(name)
+        return journal_entry(name)
+
+    monkeypatch.setattr(medicine_parser, "_scrape_name", scrape_name)
+    return names
+
+
+def test_resume_after_cut_off_journal(tmp_path, scraped):
+    names_path = tmp_path / "names.txt"
+    names_path.write_text("a\nb\nd\n", encoding='utf-8')
+
+    journal_path = tmp_path / "journal.jsonl"
+    journal_path.write_text(
+        "".join(json.dumps(journal_entry(name), ensure_ascii=False) + "\n" for name in ("a", "b"))
+        + '{"name": "x", "sta',
+        encoding='utf-8'
+    )
+
+    output_path = tmp_path / "out.json"
+    medicine_parser.parser(str(names_path), str(output_path), str(journal_path), workers=1, min_interval=0)
+
+    assert scraped == ["d"]
+    with open(output_path, encoding='utf-8') as output:
+        assert [record["Назва"] for record in json.load(output)] == ["a1", "b1", "d1"]
+
+
+def test_parser_restores_min_interval(tmp_path, scraped):
+    names_path = tmp_path / "names.txt"
+    names_path.write_text("a\n", encoding='utf-8')
+
+    pool = medicine_parser.scraper_pool.get_pool()
+    previous = pool.min_interval
+
+    medicine_parser.parser(str(names_path), str(tmp_path / "out.ndjson"), str(tmp_path / "journal.jsonl"),
+                           workers=1, min_interval=previous + 5)
+
+    assert pool.min_interval == previous
@@ -0,0 +1,57 @@
+import json
+
+from modules import ndjson
+
+
+def write_lines(path, text):
+    with open(path, "w", encoding='utf-8') as file:
+        file.write(text)
+
+
+def test_append_after_cut_off_line_keeps_new_records(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_lines(path, '{"name": "a"}\n{"name": "b"}\n{"name": "x", "sta')
+
+    with ndjson.NDJSONWriter(str(path), append=True) as writer:
+        writer.write({"name": "d"})
+
+    assert [record["name"] for record in ndjson.iter_ndjson(str(path))] == ["a", "b", "d"]
+
+
+def test_complete_record_without_newline_is_kept(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_lines(path, '{"name": "a"}\n{"name": "b"}')
+
+    assert ndjson.truncate_partial_line(str(path)) == 0
+
+    with ndjson.NDJSONWriter(str(path), append=True) as writer:
+        writer.write({"name": "c"})
+
+    assert [record["name"] for record in ndjson.iter_ndjson(str(path))] == ["a", "b", "c"]
+
+
+def test_truncate_partial_line_longer_than_a_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(ndjson, "CHUNK_SIZE", 4)
+    path = tmp_path / "journal.jsonl"
+    write_lines(path, '{"name": "a"}\n{"name": "xxxxxxxxxxxx')
+
+    assert ndjson.truncate_partial_line(str(path)) == len('{"name": "xxxxxxxxxxxx')
+    assert path.read_text(encoding='utf-8') == '{"name": "a"}\n'
+
+
+def test_truncate_partial_line_without_any_newline(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_lines(path, '{"name": "x", "sta')
+
+    ndjson.truncate_partial_line(str(path))
+
+    assert path.read_text(encoding='utf-8') == ''
+
+
+def test_truncate_partial_line_leaves_complete_files_alone(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_lines(path, json.dumps({"name": "a"}) + "\n")
+
+    assert ndjson.truncate_partial_line(str(path)) == 0
+    assert ndjson.truncate_partial_line(str(tmp_path / "missing.jsonl")) == 0
+    assert path.read_text(encoding='utf-8') == '{"name": "a"}\n'